@@ -0,0 +1,347 @@
+""" Benchmark the rendering of PyDow, headless (under plain CPython).
+
+Every scenario mounts components in an in-memory DOM and measures a workload
+of a given size: the wall time, the peak memory, the number of Jinja renders,
+compiled renders and HTML parses, and the DOM operations by type. The results
+are written as JSON, so they can be compared between versions.
+
+    python benchmark.py
+    python benchmark.py --scenario toggle --size 1000 --size 10000
+    python benchmark.py --engine jinja --output results.json
+"""
+
+from __future__ import annotations
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+from collections import Counter as OperationCounter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pydow
+import test_app
+
+from pydow import Component, Dom, HeadlessBackend
+
+
+class BenchTodos(test_app.TodoComponent):
+    """ The todo component of the demo, with its items set by the scenario
+    instead of fetched when mounted.
+    """
+
+    tag = "bench-todos"
+
+    def on_mount(self) -> None:
+        pass
+
+
+class BenchCounter(test_app.Counter):
+    """ The counter component of the demo.
+    """
+
+    tag = "bench-counter"
+
+
+class BenchNesting(Component):
+    """ A component that nests its leaf in a number of components (the template
+    is set by the scenario).
+    """
+
+    tag = "bench-nesting"
+
+
+class BenchBox(Component):
+    """ A component without a template of its own, it renders its children.
+    """
+
+    tag = "bench-box"
+
+
+class BenchLeaf(Component):
+    """ The innermost component of the nesting scenarios, it keeps track of
+    its mounted instances so its state can be written.
+    """
+
+    tag = "bench-leaf"
+    initial_state = {"count": 0}
+    template = """<span class="leaf">{{ count }}</span>"""
+    instances = []
+
+    def on_mount(self) -> None:
+        BenchLeaf.instances.append(self)
+
+
+# The components of which the scenario sets the template engine
+BENCH_COMPONENTS = [BenchTodos, BenchCounter, BenchNesting, BenchBox, BenchLeaf]
+
+
+# The scenarios by name, with their default sizes
+SCENARIOS: Dict[str, Tuple[Callable[[int], Callable[[], None]], List[int]]] = {}
+
+
+def scenario(*sizes: int) -> Callable:
+    """ Register a scenario. A scenario gets its size, prepares a DOM and
+    returns the workload to measure.
+    """
+
+    def register(function: Callable[[int], Callable[[], None]]) -> Callable:
+        SCENARIOS[function.__name__] = (function, list(sizes))
+        return function
+
+    return register
+
+
+def _mount(root: type, **initial_state: Any) -> Tuple[Dom, HeadlessBackend]:
+
+    # Create a headless DOM with an element to mount the root component in
+    backend = HeadlessBackend()
+    element = backend.document.createElement("div")
+    element.setAttribute("id", "main")
+    backend.document.body.appendChild(element)
+    if initial_state:
+        root.initial_state = initial_state
+    return Dom(root=root, selector="#main", backend=backend), backend
+
+
+def _todos(size: int) -> pydow.ObservableList:
+    return pydow.ObservableList(test_app.TodoItem(title=f"Item {i}") for i in range(size))
+
+
+def _buttons(backend: HeadlessBackend, label: str) -> list:
+    return [
+        button
+        for button in backend.document.querySelectorAll("bench-todos li button")
+        if button.textContent == label
+    ]
+
+
+@scenario(100, 1000, 10000)
+def mount(size: int) -> Callable[[], None]:
+    """ Mount a todo list with N items.
+    """
+    items = _todos(size)
+    return lambda: _mount(BenchTodos, todolist=items)
+
+
+@scenario(100, 1000, 10000)
+def toggle(size: int) -> Callable[[], None]:
+    """ Toggle the item in the middle of a todo list with N items.
+    """
+    dom, backend = _mount(BenchTodos, todolist=_todos(size))
+    button = _buttons(backend, "Done")[size // 2]
+    return button.click
+
+
+@scenario(100, 1000, 10000)
+def prepend(size: int) -> Callable[[], None]:
+    """ Add an item at the head of a todo list with N items.
+    """
+    dom, backend = _mount(BenchTodos, todolist=_todos(size))
+
+    def run() -> None:
+        dom.root.state["todolist"].insert(0, test_app.TodoItem(title="New"))
+        backend.window.run_animation_frame()
+
+    return run
+
+
+@scenario(100, 1000, 10000)
+def remove_head(size: int) -> Callable[[], None]:
+    """ Remove the item at the head of a todo list with N items.
+    """
+    dom, backend = _mount(BenchTodos, todolist=_todos(size))
+    return _buttons(backend, "Remove")[0].click
+
+
+@scenario(10, 100, 1000)
+def counter(size: int) -> Callable[[], None]:
+    """ Increment a counter K times, with a render for every click.
+    """
+    dom, backend = _mount(BenchCounter, count=0)
+    button = backend.document.querySelectorAll("bench-counter button")[1]
+
+    def run() -> None:
+        for _ in range(size):
+            button.click()
+
+    return run
+
+
+def _nest(depth: int) -> None:
+    BenchNesting.template = (
+        "<bench-box>" * depth + "<bench-leaf></bench-leaf>" + "</bench-box>" * depth
+    )
+
+
+@scenario(10, 50, 200)
+def deep_mount(size: int) -> Callable[[], None]:
+    """ Mount a leaf component nested in N components.
+    """
+    _nest(size)
+    return lambda: _mount(BenchNesting)
+
+
+@scenario(10, 50, 200)
+def deep_update(size: int) -> Callable[[], None]:
+    """ Write the state of a leaf component nested in N components.
+    """
+    _nest(size)
+    BenchLeaf.instances = []
+    dom, backend = _mount(BenchNesting)
+    leaf = BenchLeaf.instances[-1]
+
+    def run() -> None:
+        leaf.state["count"] += 1
+        backend.window.run_animation_frame()
+
+    return run
+
+
+class Counts:
+    """ Count the template renders, parses and DOM operations, by wrapping the
+    functions of PyDow that do them.
+    """
+
+    def __init__(self) -> None:
+        self.jinja_renders = 0
+        self.compiled_renders = 0
+        self.parses = 0
+        self.operations = OperationCounter()
+
+    @contextmanager
+    def recording(self) -> Iterator[Counts]:
+        render_template = Component.render_template
+        child_nodes = Component._child_nodes
+        parse_template = pydow.parse_template
+        apply = pydow.PatchApplier.apply
+
+        def count_render_template(component: Component, *args) -> str:
+            self.jinja_renders += 1
+            return render_template(component, *args)
+
+        def count_child_nodes(component: Component) -> list:
+            if component._render_nodes is not None:
+                self.compiled_renders += 1
+            return child_nodes(component)
+
+        def count_parse_template(html: str) -> list:
+            self.parses += 1
+            return parse_template(html)
+
+        def count_apply(applier: pydow.PatchApplier, patches: list) -> int:
+            self.operations.update(patch[0] for patch in patches)
+            return apply(applier, patches)
+
+        Component.render_template = count_render_template
+        Component._child_nodes = count_child_nodes
+        pydow.parse_template = count_parse_template
+        pydow.PatchApplier.apply = count_apply
+        try:
+            yield self
+        finally:
+            Component.render_template = render_template
+            Component._child_nodes = child_nodes
+            pydow.parse_template = parse_template
+            pydow.PatchApplier.apply = apply
+
+
+def run_scenario(name: str, size: int, repeat: int, engine: str) -> Dict[str, Any]:
+    """ Measure a scenario: the fastest of a number of runs, and the peak memory
+    and counts of one more run.
+    """
+    function, _ = SCENARIOS[name]
+    for component in BENCH_COMPONENTS:
+        component.template_engine = engine
+
+    times = []
+    for _ in range(repeat):
+        run = function(size)
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    run = function(size)
+    counts = Counts()
+    tracemalloc.start()
+    try:
+        with counts.recording():
+            run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "scenario": name,
+        "size": size,
+        "engine": engine,
+        "time": min(times),
+        "times": times,
+        "peak_memory": peak,
+        "jinja_renders": counts.jinja_renders,
+        "compiled_renders": counts.compiled_renders,
+        "parses": counts.parses,
+        "dom_operations": sum(counts.operations.values()),
+        "dom_operations_by_type": dict(sorted(counts.operations.items())),
+    }
+
+
+def main(arguments: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Benchmark the rendering of PyDow.")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="the scenario to run (repeatable, all scenarios by default)",
+    )
+    parser.add_argument(
+        "--size",
+        action="append",
+        type=int,
+        help="the size to run the scenarios with (repeatable, the defaults of the scenario by default)",
+    )
+    parser.add_argument(
+        "--engine",
+        action="append",
+        choices=["compiled", "jinja"],
+        help="the template engine (repeatable, both by default)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="the number of timed runs")
+    parser.add_argument("--output", help="the file to write the JSON results to (stdout by default)")
+    options = parser.parse_args(arguments)
+
+    # Deep trees render recursively
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+
+    results = []
+    for name in options.scenario or list(SCENARIOS):
+        for engine in options.engine or ["compiled", "jinja"]:
+            for size in options.size or SCENARIOS[name][1]:
+                result = run_scenario(name, size, options.repeat, engine)
+                results.append(result)
+                print(
+                    f"{name:>12} {engine:>8} {size:>6}: {result['time'] * 1000:9.2f} ms, "
+                    f"{result['dom_operations']:6} DOM operations",
+                    file=sys.stderr,
+                )
+
+    report = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if options.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(options.output, "w") as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
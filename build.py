@@ -0,0 +1,135 @@
+""" Build an app into a single bundle for the browser to load.
+
+The bundle contains PyDow, the precompiled render functions of the templates,
+the scoped CSS of the components and the app itself. Components that use the
+compiled template engine don't need Jinja2 in the browser, so Pyodide doesn't
+have to load any packages to start the app.
+
+    python build.py test_app.py
+    python build.py test_app.py --output static/bundle.py
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import argparse
+import importlib.util
+
+from typing import Any, Dict, List, Optional
+
+from pydow import compiled_template_cache, registry
+
+
+def _load_module(path: str) -> Any:
+
+    # Import the app, its components register themselves
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def collect(components: list) -> Dict[str, Any]:
+    """ Precompile the templates and scope the CSS of components. Returns the
+    bundle data, and the tags of the components that still need Jinja2.
+    """
+    templates = {}
+    css = []
+    jinja = []
+    for component in components:
+
+        # Virtual lists render their rows with a template of their own
+        sources = [component.template, getattr(component, "row_template", "")]
+        for source in sources:
+            if source == "":
+                continue
+            render = None
+            if component.template_engine == "compiled":
+                render = compiled_template_cache.get(source)
+            if render is None:
+                if component.tag not in jinja:
+                    jinja.append(component.tag)
+            else:
+                templates[source] = render.source
+        if component.css != "":
+            css.append([component.tag, component.css, registry.css(component)])
+    return {"templates": templates, "css": css, "jinja": jinja}
+
+
+class BuildError(Exception):
+    pass
+
+
+def build(app: str, framework: str, allow_jinja: bool = False) -> str:
+    """ Create the source of the bundle of an app.
+    """
+    module = _load_module(app)
+    components = [
+        component
+        for component in registry.components.values()
+        if component.__module__ == module.__name__
+    ]
+    bundle = collect(components)
+
+    # Templates that can't be precompiled need Jinja2 in the browser
+    if len(bundle["jinja"]) > 0 and not allow_jinja:
+        raise BuildError(
+            "these components need Jinja2, use the compiled template engine or "
+            f"--allow-jinja: {', '.join(bundle['jinja'])}"
+        )
+    packages = ["jinja2"] if len(bundle["jinja"]) > 0 else []
+
+    with open(framework) as file:
+        framework_source = file.read()
+    with open(app) as file:
+        app_source = file.read()
+
+    data = {"templates": bundle["templates"], "css": bundle["css"]}
+    name = os.path.basename(app)
+    return "\n".join(
+        [
+            f"# packages: {json.dumps(packages)}",
+            f"# Built from {name} by build.py, do not edit",
+            framework_source,
+            "",
+            "# The precompiled templates and scoped CSS of the app",
+            f"registry.load({data!r})",
+            "",
+            "# The app",
+            f"exec(compile({app_source!r}, {name!r}, \"exec\"), globals())",
+            "",
+        ]
+    )
+
+
+def main(arguments: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Build a PyDow app into a single bundle.")
+    parser.add_argument("app", help="the Python file of the app, e.g. test_app.py")
+    parser.add_argument("--output", default="bundle.py", help="the file to write the bundle to")
+    parser.add_argument(
+        "--framework",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "pydow.py"),
+        help="the PyDow source to include",
+    )
+    parser.add_argument(
+        "--allow-jinja",
+        action="store_true",
+        help="allow templates that aren't precompiled (the browser loads Jinja2)",
+    )
+    options = parser.parse_args(arguments)
+
+    try:
+        source = build(options.app, options.framework, options.allow_jinja)
+    except BuildError as error:
+        parser.error(str(error))
+    with open(options.output, "w") as file:
+        file.write(source)
+    print(f"Built {options.output} ({len(source) // 1024} KiB)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
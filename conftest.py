@@ -0,0 +1,31 @@
+""" Fixtures for the headless tests. Importing PyDow registers the main module,
+that the demo app (test_app.py) imports.
+"""
+
+import pytest
+
+import pydow
+
+
+@pytest.fixture
+def mount():
+    """ Mount a root component in a new headless DOM. Returns the Dom, the
+    backend and the mount element.
+    """
+    doms = []
+
+    def mount(root, mode="render", html=None):
+        backend = pydow.HeadlessBackend()
+        element = backend.document.createElement("div")
+        element.setAttribute("id", "main")
+        backend.document.body.appendChild(element)
+        if html is not None:
+            element.innerHTML = html
+        dom = pydow.Dom(root=root, selector="#main", backend=backend, mode=mode)
+        doms.append(dom)
+        return dom, backend, element
+
+    yield mount
+    for dom in doms:
+        if dom.previous_tree is not None:
+            dom.unmount()
@@ -2,20 +2,37 @@ from __future__ import annotations
 
 import re
 import sys
-import uuid
+import math
+import bisect
+import asyncio
+import html
+import json
+import time
+import inspect
+import itertools
+import contextvars
+import traceback
 import types
 
-from collections.abc import MutableMapping
-from js import document, window, Node  # type: ignore
-from bs4 import BeautifulSoup
-from bs4.element import Tag
-from typing import Type, Any, Dict, Callable, Optional, TypeVar, Union
-from jinja2 import Template
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping, MutableSequence, Sequence
+from html.parser import HTMLParser
+from typing import (
+    Type, Any, Awaitable, Dict, Callable, Iterable, Iterator, Optional, Tuple,
+    TypeVar, Union
+)
+
+# Jinja is only needed for templates that are not precompiled (see build.py)
+try:
+    from jinja2 import Template
+except ImportError:
+    Template = None
 
 
 # Create a custom type for type hinting
 JsProxy = TypeVar("JsProxy")
-Promise = TypeVar("Promise")
 
 DEBUG = False
 
@@ -38,66 +55,2618 @@ class GroupedLogs:
             console.groupEnd()
 
 
+class HeadlessNode:
+    """ Base of the nodes of the headless (pure Python, in-memory) DOM.
+    """
+
+    ELEMENT_NODE = 1
+    TEXT_NODE = 3
+
+    nodeType = 0
+
+    def __init__(self, document: Optional[HeadlessDocument]) -> None:
+        self.ownerDocument = document
+        self.parentNode = None
+
+    def remove(self) -> None:
+        if self.parentNode is not None:
+            self.parentNode.removeChild(self)
+
+
+class HeadlessText(HeadlessNode):
+
+    nodeType = HeadlessNode.TEXT_NODE
+
+    def __init__(self, document: Optional[HeadlessDocument], data: str) -> None:
+        super().__init__(document)
+        self.data = data
+
+    @property
+    def textContent(self) -> str:
+        return self.data
+
+    @textContent.setter
+    def textContent(self, value: Optional[str]) -> None:
+        self.data = "" if value is None else str(value)
+
+    @property
+    def outerHTML(self) -> str:
+        if self.parentNode is not None and self.parentNode.localName in ("style", "script"):
+            return self.data
+        return html.escape(self.data, quote=False)
+
+
+class HeadlessEvent:
+    """ An event that can be dispatched on the elements of the headless DOM.
+    """
+
+    def __init__(self, type: str, bubbles: bool = True, **properties) -> None:
+        self.type = type
+        self.bubbles = bubbles
+        self.target = None
+        self.currentTarget = None
+        self.cancelBubble = False
+        self.defaultPrevented = False
+        self.__dict__.update(properties)
+
+    def stopPropagation(self) -> None:
+        self.cancelBubble = True
+
+    def preventDefault(self) -> None:
+        self.defaultPrevented = True
+
+
+# Parts of (simple) CSS selectors: tag, #id, .class and [attribute="value"]
+_SELECTOR_PART = re.compile(
+    r"""([\w-]+)|\*|#([\w-]+)|\.([\w-]+)|\[([\w:-]+)(?:=(?:"([^"]*)"|'([^']*)'|([^\]]*)))?\]"""
+)
+
+
+def _parse_selector(selector: str) -> list:
+    """ Parse a selector into a list (descendant combinators) of lists of
+    (kind, name, value) tests.
+    """
+    compounds = []
+    for compound in selector.split():
+        tests = []
+        for match in _SELECTOR_PART.finditer(compound):
+            tag, identifier, class_name, attribute = match.group(1, 2, 3, 4)
+            if tag is not None:
+                tests.append(("tag", tag.lower(), None))
+            elif identifier is not None:
+                tests.append(("attribute", "id", identifier))
+            elif class_name is not None:
+                tests.append(("class", class_name, None))
+            elif attribute is not None:
+                value = next((x for x in match.group(5, 6, 7) if x is not None), None)
+                tests.append(("attribute", attribute.lower(), value))
+        compounds.append(tests)
+    return compounds
+
+
+def _matches_compound(element: HeadlessElement, tests: list) -> bool:
+    for kind, name, value in tests:
+        if kind == "tag" and element.localName != name:
+            return False
+        if kind == "class" and name not in element.getAttribute("class", "").split():
+            return False
+        if kind == "attribute":
+            if name not in element.attributes:
+                return False
+            if value is not None and element.attributes[name] != value:
+                return False
+    return True
+
+
+def _matches_selector(element: HeadlessElement, compounds: list) -> bool:
+
+    # Match the last compound on the element, the others on its ancestors
+    if not _matches_compound(element, compounds[-1]):
+        return False
+    ancestor = element.parentNode
+    for tests in reversed(compounds[:-1]):
+        while ancestor is not None and not (
+            isinstance(ancestor, HeadlessElement) and _matches_compound(ancestor, tests)
+        ):
+            ancestor = ancestor.parentNode
+        if ancestor is None:
+            return False
+        ancestor = ancestor.parentNode
+    return True
+
+
+class HeadlessElement(HeadlessNode):
+    """ An element of the headless DOM, with the subset of the browser API
+    that PyDow (and typical components) use.
+    """
+
+    nodeType = HeadlessNode.ELEMENT_NODE
+
+    def __init__(self, document: Optional[HeadlessDocument], tag: str) -> None:
+        super().__init__(document)
+        self.localName = tag.lower()
+        self.tagName = tag.upper()
+        self.attributes = {}
+        self.childNodes = []
+        self._listeners = []
+        self._value = None
+
+    # Attributes
+
+    def getAttribute(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.attributes.get(name.lower(), default)
+
+    def setAttribute(self, name: str, value: Any) -> None:
+        self.attributes[name.lower()] = str(value)
+
+    def removeAttribute(self, name: str) -> None:
+        self.attributes.pop(name.lower(), None)
+
+    def hasAttribute(self, name: str) -> bool:
+        return name.lower() in self.attributes
+
+    @property
+    def id(self) -> str:
+        return self.getAttribute("id", "")
+
+    @property
+    def className(self) -> str:
+        return self.getAttribute("class", "")
+
+    @property
+    def value(self) -> str:
+        return self.getAttribute("value", "") if self._value is None else self._value
+
+    @value.setter
+    def value(self, value: str) -> None:
+        self._value = value
+
+    # Tree
+
+    @property
+    def children(self) -> list:
+        return [node for node in self.childNodes if node.nodeType == HeadlessNode.ELEMENT_NODE]
+
+    @property
+    def firstChild(self) -> Optional[HeadlessNode]:
+        return self.childNodes[0] if len(self.childNodes) > 0 else None
+
+    @property
+    def lastChild(self) -> Optional[HeadlessNode]:
+        return self.childNodes[-1] if len(self.childNodes) > 0 else None
+
+    @property
+    def lastElementChild(self) -> Optional[HeadlessElement]:
+        children = self.children
+        return children[-1] if len(children) > 0 else None
+
+    def appendChild(self, node: HeadlessNode) -> HeadlessNode:
+        return self.insertBefore(node, None)
+
+    def insertBefore(self, node: HeadlessNode, reference: Optional[HeadlessNode]) -> HeadlessNode:
+        node.remove()
+        if reference is None:
+            self.childNodes.append(node)
+        else:
+            self.childNodes.insert(self.childNodes.index(reference), node)
+        node.parentNode = self
+        return node
+
+    def removeChild(self, node: HeadlessNode) -> HeadlessNode:
+        self.childNodes.remove(node)
+        node.parentNode = None
+        return node
+
+    def _descendants(self) -> Iterator[HeadlessElement]:
+        for child in self.children:
+            yield child
+            yield from child._descendants()
+
+    def querySelectorAll(self, selector: str) -> list:
+        compounds = _parse_selector(selector)
+        return [
+            element for element in self._descendants()
+            if _matches_selector(element, compounds)
+        ]
+
+    def querySelector(self, selector: str) -> Optional[HeadlessElement]:
+        compounds = _parse_selector(selector)
+        return next(
+            (element for element in self._descendants() if _matches_selector(element, compounds)),
+            None,
+        )
+
+    # Content
+
+    @property
+    def textContent(self) -> str:
+        return "".join(node.textContent for node in self.childNodes)
+
+    @textContent.setter
+    def textContent(self, value: Optional[str]) -> None:
+        for node in self.childNodes:
+            node.parentNode = None
+        self.childNodes = []
+        if value is not None and value != "":
+            self.appendChild(HeadlessText(self.ownerDocument, str(value)))
+
+    @property
+    def innerHTML(self) -> str:
+        return "".join(node.outerHTML for node in self.childNodes)
+
+    @innerHTML.setter
+    def innerHTML(self, value: str) -> None:
+        self.textContent = None
+        builder = _HeadlessTreeBuilder(self)
+        builder.feed(value)
+        builder.close()
+
+    @property
+    def outerHTML(self) -> str:
+        attributes = "".join(
+            f' {name}="{html.escape(value)}"' for name, value in self.attributes.items()
+        )
+        if self.localName in VOID_ELEMENTS:
+            return f"<{self.localName}{attributes}>"
+        return f"<{self.localName}{attributes}>{self.innerHTML}</{self.localName}>"
+
+    # Events
+
+    def addEventListener(self, type: str, listener: Callable, capture: bool = False) -> None:
+        if (type, listener, capture) not in self._listeners:
+            self._listeners.append((type, listener, bool(capture)))
+
+    def removeEventListener(self, type: str, listener: Callable, capture: bool = False) -> None:
+        if (type, listener, bool(capture)) in self._listeners:
+            self._listeners.remove((type, listener, bool(capture)))
+
+    def _invoke(self, event: HeadlessEvent, phases: tuple) -> None:
+        event.currentTarget = self
+        for type, listener, capture in list(self._listeners):
+            if type == event.type and capture in phases:
+                listener(event)
+
+    def dispatchEvent(self, event: HeadlessEvent) -> bool:
+
+        # Capture from the root down, then the target, then bubble up
+        event.target = self
+        ancestors = []
+        node = self.parentNode
+        while node is not None:
+            ancestors.append(node)
+            node = node.parentNode
+        for node in reversed(ancestors):
+            if event.cancelBubble:
+                break
+            node._invoke(event, (True,))
+        if not event.cancelBubble:
+            self._invoke(event, (True, False))
+        if event.bubbles:
+            for node in ancestors:
+                if event.cancelBubble:
+                    break
+                node._invoke(event, (False,))
+        return not event.defaultPrevented
+
+    def click(self) -> None:
+        self.dispatchEvent(HeadlessEvent("click"))
+
+
+class _HeadlessTreeBuilder(HTMLParser):
+    """ Build headless elements from HTML (for setting innerHTML).
+    """
+
+    def __init__(self, root: HeadlessElement) -> None:
+        super().__init__(convert_charrefs=True)
+        self.document = root.ownerDocument
+        self.stack = [root]
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        element = HeadlessElement(self.document, tag)
+        for name, value in attrs:
+            element.setAttribute(name, "" if value is None else value)
+        self.stack[-1].appendChild(element)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag: str, attrs: list) -> None:
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.stack.pop()
+
+    def handle_endtag(self, tag: str) -> None:
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].localName == tag:
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data: str) -> None:
+        self.stack[-1].appendChild(HeadlessText(self.document, data))
+
+
+class HeadlessDocument:
+    """ The document of the headless DOM, with an (empty) head and body.
+    """
+
+    def __init__(self) -> None:
+        self.documentElement = HeadlessElement(self, "html")
+        self.head = self.documentElement.appendChild(HeadlessElement(self, "head"))
+        self.body = self.documentElement.appendChild(HeadlessElement(self, "body"))
+
+    def createElement(self, tag: str) -> HeadlessElement:
+        return HeadlessElement(self, tag)
+
+    def createTextNode(self, data: str) -> HeadlessText:
+        return HeadlessText(self, data)
+
+    def querySelector(self, selector: str) -> Optional[HeadlessElement]:
+        if _matches_selector(self.documentElement, _parse_selector(selector)):
+            return self.documentElement
+        return self.documentElement.querySelector(selector)
+
+    def querySelectorAll(self, selector: str) -> list:
+        return self.documentElement.querySelectorAll(selector)
+
+    def getElementById(self, identifier: str) -> Optional[HeadlessElement]:
+        return self.querySelector(f"#{identifier}")
+
+
+class HeadlessConsole:
+    """ Print the console messages of the headless window.
+    """
+
+    def __init__(self) -> None:
+        self.depth = 0
+
+    def log(self, *args) -> None:
+        print("  " * self.depth + " ".join(str(arg) for arg in args))
+
+    info = log
+    debug = log
+
+    def warn(self, *args) -> None:
+        print("  " * self.depth + " ".join(str(arg) for arg in args), file=sys.stderr)
+
+    error = warn
+
+    def group(self, *args) -> None:
+        self.log(*args)
+        self.depth += 1
+
+    groupCollapsed = group
+
+    def groupEnd(self) -> None:
+        self.depth = max(0, self.depth - 1)
+
+
+class HeadlessPromise:
+    """ A minimal promise, its callbacks run as tasks of the headless window.
+    """
+
+    def __init__(self, window: HeadlessWindow) -> None:
+        self.window = window
+        self.settled = False
+        self.value = None
+        self.error = None
+        self._callbacks = []
+
+    def _settle(self, value: Any = None, error: Optional[BaseException] = None) -> None:
+        if self.settled:
+            return
+
+        # Adopt the outcome of a promise that is resolved with a promise
+        if isinstance(value, HeadlessPromise):
+            value.then(self._settle, lambda error: self._settle(error=error))
+            return
+        self.settled, self.value, self.error = True, value, error
+        for callback in self._callbacks:
+            self.window.queue_task(callback)
+        self._callbacks = []
+
+    def resolve(self, value: Any = None) -> HeadlessPromise:
+        self._settle(value=value)
+        return self
+
+    def reject(self, error: BaseException) -> HeadlessPromise:
+        self._settle(error=error)
+        return self
+
+    def then(
+        self,
+        on_fulfilled: Optional[Callable] = None,
+        on_rejected: Optional[Callable] = None,
+    ) -> HeadlessPromise:
+        promise = HeadlessPromise(self.window)
+
+        def callback() -> None:
+            handler = on_fulfilled if self.error is None else on_rejected
+            if handler is None:
+                promise._settle(self.value, self.error)
+                return
+            try:
+                promise._settle(handler(self.value if self.error is None else self.error))
+            except Exception as error:
+                promise._settle(error=error)
+
+        if self.settled:
+            self.window.queue_task(callback)
+        else:
+            self._callbacks.append(callback)
+        return promise
+
+    def catch(self, on_rejected: Callable) -> HeadlessPromise:
+        return self.then(None, on_rejected)
+
+    def __await__(self) -> Iterator[Any]:
+
+        # Wait for the promise on the (asyncio) loop of the window
+        if not self.settled:
+            future = self.window.loop.create_future()
+
+            def settle(value: Any = None, error: Optional[BaseException] = None) -> None:
+                if not future.done():
+                    if error is None:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(error)
+
+            self.then(settle, lambda error: settle(error=error))
+            yield from future.__await__()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class HeadlessResponse:
+    """ The response of a fetch in the headless window.
+    """
+
+    def __init__(self, window: HeadlessWindow, body: str, status: int = 200) -> None:
+        self.window = window
+        self.body = body
+        self.status = status
+        self.ok = 200 <= status < 300
+
+    def text(self) -> HeadlessPromise:
+        return HeadlessPromise(self.window).resolve(self.body)
+
+    def json(self) -> HeadlessPromise:
+        return HeadlessPromise(self.window).resolve(json.loads(self.body))
+
+
+class HeadlessPerformance:
+    """ A fake clock (in milliseconds), time only passes when it is advanced.
+    To simulate work that takes time, every reading can advance it by a tick.
+    """
+
+    def __init__(self) -> None:
+        self.time = 0.0
+        self.tick = 0.0
+
+    def now(self) -> float:
+        now = self.time
+        self.time += self.tick
+        return now
+
+    def advance(self, milliseconds: float) -> None:
+        self.time += milliseconds
+
+
+def _no_transport(url: str, options: Dict[str, Any]) -> Any:
+    raise ConnectionError(f"The headless window has no transport to fetch {url}")
+
+
+class HeadlessWindow:
+    """ The window of the headless DOM. Tasks (promise callbacks) and
+    animation frames only run when asked to, and the clock is fake, which
+    makes them deterministic.
+    """
+
+    def __init__(self) -> None:
+        self.document = HeadlessDocument()
+        self.console = HeadlessConsole()
+        self.performance = HeadlessPerformance()
+
+        # A function (url, options) -> (status, body) to serve fetch requests
+        self.transport = _no_transport
+        self._tasks = []
+        self._frames = {}
+        self._frame_ids = itertools.count(1)
+        self._loop = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """ The asyncio loop of the window, it runs along with the tasks.
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+
+    def queue_task(self, task: Callable[[], None]) -> None:
+        self._tasks.append(task)
+
+    def run_tasks(self) -> None:
+        """ Run the pending tasks, and the callbacks of the asyncio loop that
+        are ready, until there are none left.
+        """
+        while True:
+            while len(self._tasks) > 0:
+                self._tasks.pop(0)()
+            if self._loop is None:
+                return
+
+            # Run a single iteration of the loop
+            self._loop.call_soon(self._loop.stop)
+            self._loop.run_forever()
+            if len(self._tasks) == 0 and len(self._loop._ready) == 0:
+                return
+
+    def requestAnimationFrame(self, callback: Callable[[float], None]) -> int:
+        frame_id = next(self._frame_ids)
+        self._frames[frame_id] = callback
+        return frame_id
+
+    def cancelAnimationFrame(self, frame_id: int) -> None:
+        self._frames.pop(frame_id, None)
+
+    def run_animation_frame(self, timestamp: Optional[float] = None) -> None:
+        """ Run the pending tasks, then the callbacks of the next animation frame.
+        """
+        self.run_tasks()
+        frames, self._frames = self._frames, {}
+        timestamp = self.performance.now() if timestamp is None else timestamp
+        for callback in frames.values():
+            callback(timestamp)
+        self.run_tasks()
+
+    def fetch(self, url: str, options: Optional[Dict[str, Any]] = None) -> HeadlessPromise:
+        promise = HeadlessPromise(self)
+        try:
+            status, body = self.transport(url, options or {})
+        except Exception as error:
+            return promise.reject(error)
+        return promise.resolve(HeadlessResponse(self, body, status))
+
+
+class BrowserBackend:
+    """ The DOM of the browser, through the js module of Pyodide.
+    """
+
+    def __init__(self) -> None:
+        import js  # type: ignore
+
+        self.window = js.window
+        self.document = js.document
+        self.Node = js.Node
+
+        # Pyodide runs asyncio on the event loop of the browser
+        self.loop = asyncio.get_event_loop()
+
+    def now(self) -> float:
+
+        # The clock of the browser, without crossing over to JavaScript
+        return time.perf_counter() * 1000
+
+    def request_animation_frame(self, callback: Callable[[float], None]) -> int:
+        from pyodide.ffi import create_once_callable  # type: ignore
+
+        # JavaScript only borrows the functions it is called with, the proxy
+        # has to live until the frame
+        return self.window.requestAnimationFrame(create_once_callable(callback))
+
+    def create_applier(self, dispatch: Callable[[int, JsProxy], None]) -> JsPatchApplier:
+        return JsPatchApplier(dispatch=dispatch, window=self.window)
+
+    async def fetch(self, url: str, options: Dict[str, Any]) -> Tuple[int, str]:
+        from pyodide.ffi import to_js  # type: ignore
+
+        response = await self.window.fetch(
+            url, to_js(options, dict_converter=self.window.Object.fromEntries)
+        )
+        return response.status, await response.text()
+
+
+class HeadlessBackend:
+    """ A pure Python, in-memory DOM. Allows running (and profiling) PyDow
+    under plain CPython.
+    """
+
+    def __init__(self) -> None:
+        self.window = HeadlessWindow()
+        self.document = self.window.document
+        self.Node = HeadlessNode
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self.window.loop
+
+    def now(self) -> float:
+        return self.window.performance.now()
+
+    def request_animation_frame(self, callback: Callable[[float], None]) -> int:
+        return self.window.requestAnimationFrame(callback)
+
+    def create_applier(self, dispatch: Callable[[int, JsProxy], None]) -> PatchApplier:
+        return PatchApplier(dispatch=dispatch, document=self.document)
+
+    async def fetch(self, url: str, options: Dict[str, Any]) -> Tuple[int, str]:
+        response = await self.window.fetch(url, options)
+        return response.status, await response.text()
+
+
+def _create_default_backend() -> Union[BrowserBackend, HeadlessBackend]:
+    try:
+        return BrowserBackend()
+    except ImportError:
+        return HeadlessBackend()
+
+
+# The backend that is used when a Dom is created without one
+default_backend = _create_default_backend()
+
+
 # Add shortcut
-console = window.console
+console = default_backend.window.console
 console.grouped = GroupedLogs
 
 
+class FetchResponse:
+    """ The response of a request of the fetch client. Cached responses are
+    shared by everyone that requests them, the JSON is decoded only once (so
+    it shouldn't be changed in place).
+    """
+
+    def __init__(self, url: str, status: int, body: str) -> None:
+        self.url = url
+        self.status = status
+        self.ok = 200 <= status < 300
+        self.body = body
+        self._json = None
+        self._decoded = False
+
+    def text(self) -> str:
+        return self.body
+
+    def json(self) -> Any:
+        if not self._decoded:
+            self._json = json.loads(self.body)
+            self._decoded = True
+        return self._json
+
+
+# The backend of the Dom that runs the current task, fetch sends its requests
+# through it
+_current_backend = contextvars.ContextVar("pydow_backend", default=None)
+
+
 class fetch:
-    """ Wrap the fetch API of the browser.
+    """ An awaitable client for the fetch API. Identical requests that are in
+    flight are only sent once, successful responses to GET requests are kept
+    in a bounded (least recently used) cache for ttl seconds. Requests are
+    sent through the backend of the client, or else the backend of the Dom
+    whose task makes them.
+
+        response = await fetch(url, {"method": "POST", "body": data})
+    """
+
+    CACHED_METHODS = ("GET", "HEAD")
+
+    def __init__(
+        self,
+        backend: Optional[Union[BrowserBackend, HeadlessBackend]] = None,
+        maxsize: int = 128,
+        ttl: float = 60.0,
+    ) -> None:
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = time.monotonic
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._responses = OrderedDict()
+        self._in_flight = {}
+
+    async def __call__(
+        self,
+        url: str,
+        options: Optional[Dict[str, Any]] = None,
+        cache: bool = True,
+        ttl: Optional[float] = None,
+    ) -> FetchResponse:
+        options = dict(options or {})
+        options["method"] = options.get("method", "GET").upper()
+        backend = self.backend
+        if backend is None:
+            backend = _current_backend.get()
+        if backend is None:
+            backend = default_backend
+
+        # Only requests without side effects are shared and cached
+        if not cache or options["method"] not in self.CACHED_METHODS:
+            return await self._request(backend, url, options, None, 0.0)
+        key = (
+            id(backend),
+            options["method"],
+            url,
+            tuple(sorted(options.get("headers", {}).items())),
+            options.get("body"),
+        )
+
+        # Use the cached response, if it didn't expire yet
+        if key in self._responses:
+            expires, response = self._responses[key]
+            if expires > self.clock():
+                self.hits += 1
+                self._responses.move_to_end(key)
+                return response
+            del self._responses[key]
+
+        # Share the request with the identical requests that are in flight. It
+        # is shielded, so cancelling one of them doesn't cancel the others
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(
+                self._request(backend, url, options, key, self.ttl if ttl is None else ttl)
+            )
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _request(
+        self,
+        backend: Union[BrowserBackend, HeadlessBackend],
+        url: str,
+        options: Dict[str, Any],
+        key: Optional[tuple],
+        ttl: float,
+    ) -> FetchResponse:
+        self.requests += 1
+        status, body = await backend.fetch(url, options)
+        response = FetchResponse(url, status, body)
+
+        # Cache the successful response, evict the least recently used one if needed
+        if key is not None and response.ok and ttl > 0:
+            self._responses[key] = (self.clock() + ttl, response)
+            if len(self._responses) > self.maxsize:
+                self._responses.popitem(last=False)
+        return response
+
+    def clear(self) -> None:
+        self._responses.clear()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    def info(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "in_flight": len(self._in_flight),
+            "size": len(self._responses),
+            "maxsize": self.maxsize,
+        }
+
+
+# The number of bits of an index (or hash) that select the child of a trie node
+_BITS = 5
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+
+
+class Persistent:
+    """ Base of the immutable collections. Every change returns a new version
+    that shares the unchanged parts with the previous one, so a changed value
+    is never identical to the previous one: comparing the identity of two
+    versions is enough to know if anything changed.
+    """
+
+    __slots__ = ()
+
+    def __copy__(self) -> Persistent:
+        return self
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> Persistent:
+        return self
+
+
+class PersistentList(Persistent, Sequence):
+    """ An immutable list, stored as a trie of nodes with 32 children. Setting,
+    appending and getting an item take O(log32 n), other changes (insert and
+    delete) rebuild the list in O(n).
+    """
+
+    __slots__ = ("_root", "_count", "_shift")
+
+    def __init__(self, items: Iterable[Any] = ()) -> None:
+        leaves = list(items)
+        self._count = len(leaves)
+        self._shift = 0
+
+        # Build the trie bottom up, from nodes with the items
+        nodes = [leaves[i:i + _WIDTH] for i in range(0, len(leaves), _WIDTH)] or [[]]
+        while len(nodes) > 1:
+            nodes = [nodes[i:i + _WIDTH] for i in range(0, len(nodes), _WIDTH)]
+            self._shift += _BITS
+        self._root = nodes[0]
+
+    @classmethod
+    def _create(cls, root: list, count: int, shift: int) -> PersistentList:
+        result = cls.__new__(cls)
+        result._root, result._count, result._shift = root, count, shift
+        return result
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        if isinstance(index, slice):
+            return PersistentList(list(self)[index])
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("PersistentList index out of range")
+        node = self._root
+        for level in range(self._shift, 0, -_BITS):
+            node = node[(index >> level) & _MASK]
+        return node[index & _MASK]
+
+    def __iter__(self) -> Iterator[Any]:
+        stack = [(self._root, self._shift)]
+        while len(stack) > 0:
+            node, shift = stack.pop()
+            if shift == 0:
+                yield from node
+            else:
+                stack.extend((child, shift - _BITS) for child in reversed(node))
+
+    def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
+        if isinstance(other, (list, tuple, PersistentList)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"PersistentList({list(self)!r})"
+
+    def __add__(self, other: Iterable[Any]) -> PersistentList:
+        return self.extend(other)
+
+    def set(self, index: int, value: Any) -> PersistentList:
+        """ Get a new version of the list, with the item at the index replaced.
+        """
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("PersistentList index out of range")
+
+        # Copy the nodes on the path to the item, share all others
+        root = list(self._root)
+        node = root
+        for level in range(self._shift, 0, -_BITS):
+            child = (index >> level) & _MASK
+            node[child] = list(node[child])
+            node = node[child]
+        node[index & _MASK] = value
+        return self._create(root, self._count, self._shift)
+
+    def append(self, value: Any) -> PersistentList:
+        """ Get a new version of the list, with an item added at the end.
+        """
+        index, shift = self._count, self._shift
+
+        # Add a level to the trie if it is full
+        if index == _WIDTH << shift:
+            root = [self._root, self._path(shift, value)]
+            return self._create(root, index + 1, shift + _BITS)
+
+        # Copy the nodes on the path to the new item, create the missing ones
+        root = list(self._root)
+        node = root
+        for level in range(shift, 0, -_BITS):
+            child = (index >> level) & _MASK
+            if child == len(node):
+                node.append(self._path(level - _BITS, value))
+                return self._create(root, index + 1, shift)
+            node[child] = list(node[child])
+            node = node[child]
+        node.append(value)
+        return self._create(root, index + 1, shift)
+
+    @staticmethod
+    def _path(shift: int, value: Any) -> list:
+        node = [value]
+        for _ in range(0, shift, _BITS):
+            node = [node]
+        return node
+
+    def extend(self, values: Iterable[Any]) -> PersistentList:
+        result = self
+        for value in values:
+            result = result.append(value)
+        return result
+
+    def insert(self, index: int, value: Any) -> PersistentList:
+        items = list(self)
+        items.insert(index, value)
+        return PersistentList(items)
+
+    def delete(self, index: int) -> PersistentList:
+        items = list(self)
+        del items[index]
+        return PersistentList(items)
+
+    def remove(self, value: Any) -> PersistentList:
+        return self.delete(self.index(value))
+
+
+class PersistentDict(Persistent, Mapping):
+    """ An immutable dictionary, stored as a trie (on the hash of the keys) of
+    nodes with up to 32 children. Getting, setting and deleting a key take
+    O(log32 n).
     """
 
-    def __call__(self, url: str, options: Dict[str, Any] = {}) -> Promise:
-        return window.fetch(url).then(lambda response: response.text())
+    __slots__ = ("_root", "_count")
+
+    # Below this depth, the keys of which all bits of the hash collide are
+    # kept together in a bucket
+    _MAX_SHIFT = 64
+
+    def __init__(self, items: Any = (), **kwargs) -> None:
+        self._root = {}
+        self._count = 0
+        pairs = items.items() if isinstance(items, Mapping) else items
+        for key, value in itertools.chain(pairs, kwargs.items()):
+            self._root, added = self._set(self._root, 0, hash(key), key, value)
+            self._count += added
+
+    @classmethod
+    def _create(cls, root: dict, count: int) -> PersistentDict:
+        result = cls.__new__(cls)
+        result._root, result._count = root, count
+        return result
+
+    def _set(self, node: dict, shift: int, key_hash: int, key: Any, value: Any) -> Tuple[dict, int]:
+
+        # Nodes are dictionaries of the children by the bits of the hash, the
+        # children are nodes, (key, value) tuples or buckets (lists of tuples)
+        node = dict(node)
+        if shift >= self._MAX_SHIFT:
+            bucket = [(k, v) for k, v in node.get(0, []) if k != key]
+            added = int(len(bucket) == len(node.get(0, [])))
+            node[0] = bucket + [(key, value)]
+            return node, added
+        child = (key_hash >> shift) & _MASK
+        entry = node.get(child)
+        if entry is None:
+            node[child] = (key, value)
+            return node, 1
+        if isinstance(entry, tuple):
+            if entry[0] is key or entry[0] == key:
+                node[child] = (key, value)
+                return node, 0
+
+            # Push the existing entry down into a node of its own
+            entry, _ = self._set({}, shift + _BITS, hash(entry[0]), entry[0], entry[1])
+        node[child], added = self._set(entry, shift + _BITS, key_hash, key, value)
+        return node, added
+
+    def _find(self, key: Any) -> Any:
+        node, shift, key_hash = self._root, 0, hash(key)
+        while True:
+            if shift >= self._MAX_SHIFT:
+                for k, v in node.get(0, []):
+                    if k is key or k == key:
+                        return (k, v)
+                return None
+            entry = node.get((key_hash >> shift) & _MASK)
+            if entry is None or isinstance(entry, tuple):
+                if entry is not None and (entry[0] is key or entry[0] == key):
+                    return entry
+                return None
+            node, shift = entry, shift + _BITS
+
+    def __getitem__(self, key: Any) -> Any:
+        entry = self._find(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def __contains__(self, key: Any) -> bool:
+        return self._find(key) is not None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[Any]:
+        stack = [(self._root, 0)]
+        while len(stack) > 0:
+            node, shift = stack.pop()
+            if shift >= self._MAX_SHIFT:
+                yield from (key for key, _ in node.get(0, []))
+                continue
+            for entry in node.values():
+                if isinstance(entry, tuple):
+                    yield entry[0]
+                else:
+                    stack.append((entry, shift + _BITS))
+
+    def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"PersistentDict({dict(self.items())!r})"
+
+    def set(self, key: Any, value: Any) -> PersistentDict:
+        """ Get a new version of the dictionary, with the value of the key set.
+        """
+        root, added = self._set(self._root, 0, hash(key), key, value)
+        return self._create(root, self._count + added)
+
+    def delete(self, key: Any) -> PersistentDict:
+        """ Get a new version of the dictionary, without the key.
+        """
+        if key not in self:
+            raise KeyError(key)
+        return self._create(self._delete(self._root, 0, hash(key), key), self._count - 1)
+
+    def _delete(self, node: dict, shift: int, key_hash: int, key: Any) -> dict:
+        node = dict(node)
+        if shift >= self._MAX_SHIFT:
+            node[0] = [(k, v) for k, v in node[0] if k != key]
+            return node
+        child = (key_hash >> shift) & _MASK
+        entry = node[child]
+        if isinstance(entry, tuple):
+            del node[child]
+        else:
+            node[child] = self._delete(entry, shift + _BITS, key_hash, key)
+        return node
+
+    def update(self, *args, **kwargs) -> PersistentDict:
+        result = self
+        for key, value in dict(*args, **kwargs).items():
+            result = result.set(key, value)
+        return result
+
+
+class ObservableList(MutableSequence):
+    """ A list that records its changes, so the {% for %} loops over it (in
+    compiled templates) only update the rows that changed. Every change is a
+    record (version, operation, index, item), where the operation is
+    "insert", "remove", "set" or "reset" (for changes to the entire list,
+    like sorting it).
+    """
+
+    def __init__(self, items: Iterable[Any] = ()) -> None:
+        self._items = list(items)
+        self.version = 0
+
+        # The states (and their keys) that the list is stored in
+        self._observers = []
+
+    def _changed(self, operation: str, index: Optional[int] = None, item: Any = None) -> None:
+        self.version += 1
+        change = (self.version, operation, index, item)
+        for state, key in list(self._observers):
+            state.changed(key, change)
+
+    def _observe(self, state: State, key: str) -> None:
+        self._observers.append((state, key))
+
+    def _unobserve(self, state: State, key: str) -> None:
+        for i, (observer, observed_key) in enumerate(self._observers):
+            if observer is state and observed_key == key:
+                del self._observers[i]
+                return
+
+    def _index(self, index: int) -> int:
+        if index < 0:
+            index += len(self._items)
+        if not 0 <= index < len(self._items):
+            raise IndexError("ObservableList index out of range")
+        return index
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        return self._items[index]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._items)
+
+    def __setitem__(self, index: Union[int, slice], value: Any) -> None:
+        if isinstance(index, slice):
+            self._items[index] = value
+            self._changed("reset")
+        else:
+            index = self._index(index)
+            self._items[index] = value
+            self._changed("set", index, value)
+
+    def __delitem__(self, index: Union[int, slice]) -> None:
+        if isinstance(index, slice):
+            del self._items[index]
+            self._changed("reset")
+        else:
+            index = self._index(index)
+            del self._items[index]
+            self._changed("remove", index)
+
+    def insert(self, index: int, value: Any) -> None:
+
+        # Clamp the index like list.insert, so the record has the actual index
+        if index < 0:
+            index = max(0, index + len(self._items))
+        index = min(index, len(self._items))
+        self._items.insert(index, value)
+        self._changed("insert", index, value)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._changed("reset")
+
+    def reverse(self) -> None:
+        self._items.reverse()
+        self._changed("reset")
+
+    def sort(self, *args, **kwargs) -> None:
+        self._items.sort(*args, **kwargs)
+        self._changed("reset")
+
+    def copy(self) -> ObservableList:
+        return ObservableList(self._items)
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, ObservableList):
+            return self._items == other._items
+        if isinstance(other, list):
+            return self._items == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"ObservableList({self._items!r})"
+
+
+class DictDiffer:
+    """ Calculate the difference between 2 dictionaries.
+    """
+
+    def __init__(self, current_dict: Dict[str, Any], past_dict: Dict[str, Any]) -> None:
+        self.current_dict, self.past_dict = current_dict, past_dict
+        self.set_current, self.set_past = (
+            set(current_dict.keys()),
+            set(past_dict.keys()),
+        )
+        self.intersect = self.set_current.intersection(self.set_past)
+
+    def added(self):
+        return self.set_current - self.intersect
+
+    def removed(self):
+        return self.set_past - self.intersect
+
+    def changed(self):
+        return set(
+            o for o in self.intersect if self.past_dict[o] != self.current_dict[o]
+        )
+
+
+def _jinja_template(source: str) -> Template:
+    if Template is None:
+        raise ImportError(
+            "Jinja2 is required for templates that are not precompiled (see build.py)"
+        )
+    return Template(source)
+
+
+class TemplateCache:
+    """ A bounded (least recently used) cache of compiled templates, keyed by
+    the template source. Shared by all components, so identical templates are
+    only compiled once.
+    """
+
+    def __init__(
+        self, maxsize: int = 512, compile: Optional[Callable[[str], Any]] = None
+    ) -> None:
+        self.maxsize = maxsize
+        self.compile = _jinja_template if compile is None else compile
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+
+    def get(self, source: str) -> Template:
+        if source in self._templates:
+            template = self._templates[source]
+            self.hits += 1
+            self._templates.move_to_end(source)
+            return template
+
+        # Compile the template, evict the least recently used one if needed
+        self.misses += 1
+        template = self.compile(source)
+        self._templates[source] = template
+        if len(self._templates) > self.maxsize:
+            self._templates.popitem(last=False)
+        return template
+
+    def add(self, source: str, template: Any) -> None:
+        """ Add a template that was compiled beforehand.
+        """
+        self._templates[source] = template
+        self._templates.move_to_end(source)
+        if len(self._templates) > self.maxsize:
+            self._templates.popitem(last=False)
+
+    def clear(self) -> None:
+        self._templates.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._templates),
+            "maxsize": self.maxsize,
+        }
+
+    def __len__(self) -> int:
+        return len(self._templates)
+
+
+# Elements that never have children (or an end tag)
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "param", "source", "track", "wbr",
+}
+
+
+class ShadowNode(ABC):
+    """ Base for the nodes in the shadow DOM, both plain elements and custom
+    components. Rendering a node diffs it against its previous version and
+    records the changes as patches, that are committed to the DOM in one go.
+    """
+
+    __slots__ = ()
+
+    @property
+    def element(self) -> JsProxy:
+        """ The DOM element of this node (only available after a commit).
+        """
+        return self.dom.applier.element(self.node_id)
+
+    @abstractmethod
+    def _child_nodes(self) -> list:
+        """ Get the (unresolved) nodes that make up the children of this node.
+        """
+
+    def _create_element(self, parent_id: Optional[int], index: Optional[int] = None) -> None:
+        self.node_id = next(_node_ids)
+        patches = self.dom.patches
+
+        # When hydrating, adopt the existing (server rendered) element and only
+        # listen for its events. Its attributes and text are checked, not set
+        if self.dom.hydrating:
+            attributes = {
+                attribute: _attribute_value(value)
+                for attribute, value in self.attributes.items()
+            }
+            patches.append(
+                ["adopt", self.node_id, parent_id, index, self.tag, attributes, self.content]
+            )
+            for event in self.event_handlers:
+                patches.append(["listen", self.node_id, event])
+            if len(self.event_handlers) > 0:
+                self.dom.set_handler(self.node_id, self)
+            return
+
+        # Create a DOM element to represent this object
+        patches.append(["create", self.node_id, self.tag])
+
+        # Set attributes
+        for attribute, value in self.attributes.items():
+            patches.append(["setAttr", self.node_id, attribute, _attribute_value(value)])
+
+        # Create event listeners
+        for event in self.event_handlers:
+            patches.append(["listen", self.node_id, event])
+        if len(self.event_handlers) > 0:
+            self.dom.set_handler(self.node_id, self)
+
+        # Add any content (text)
+        if self.content is not None:
+            patches.append(["setText", self.node_id, self.content])
+
+        # Add the element to its parent
+        if parent_id is not None:
+            patches.append(["insert", self.node_id, parent_id, None])
+
+    def _adopt(self, previous_tree: ShadowNode) -> None:
+
+        # Copy the info from the previous element, since they are the same
+        self.node_id = previous_tree.node_id
+
+    def _update_event_handlers(self, oldEvent_handlers: Dict[str, Callable]) -> None:
+
+        # Only (un)listen for events that were added or removed, the handlers
+        # themselves are looked up in the handler table when an event fires
+        diff = DictDiffer(self.event_handlers, oldEvent_handlers)
+        for key in diff.added():
+            self.dom.patches.append(["listen", self.node_id, key])
+        for key in diff.removed():
+            self.dom.patches.append(["unlisten", self.node_id, key])
+        self.dom.set_handler(self.node_id, self if len(self.event_handlers) > 0 else None)
+
+    def _update_attributes(self, oldAttributes: Dict[str, Any]) -> None:
+
+        # Check which attributes have changed, and update accordingly
+        diff = DictDiffer(self.attributes, oldAttributes)
+        for key in diff.added() | diff.changed():
+            self.dom.patches.append(
+                ["setAttr", self.node_id, key, _attribute_value(self.attributes[key])]
+            )
+        for key in diff.removed():
+            self.dom.patches.append(["removeAttr", self.node_id, key])
+
+    def _update_content(self, oldContent: Optional[str]) -> None:
+
+        # Compare with the content of the previous shadow node, the text of the
+        # element itself is never read back from the DOM
+        if (self.content or "") != (oldContent or ""):
+            self.dom.patches.append(["setText", self.node_id, self.content])
+
+    def _create_children(self) -> list:
+
+        # Loop the children from the template
+        return [self._create_child(child) for child in self._child_nodes()]
+
+    def _create_child(self, child: VNode) -> ShadowNode:
+        if not isinstance(child, VNode):
+            raise Exception("child is not a VNode")
+        owner = self.top_custom_component
+        dom = owner.dom
+
+        # Get the attributes, the key is only used to match children
+        attrs = dict(
+            {
+                key: value
+                for key, value in child.attributes.items()
+                if not key.startswith("on:")
+            }
+        )
+        key = attrs.pop("key", None)
+
+        # Only elements without nested tags have text content of their own
+        content = child.content if len(child.children) == 0 else None
+
+        # Extract event handlers
+        event_handlers = {
+            key[3:]: getattr(owner, value, lambda x: print("not implemented"))
+            for key, value in child.attributes.items()
+            if key.startswith("on:")
+        }
+
+        # Create a custom component, or a copy of the node for a plain element
+        # (the nodes that are handed down to a component are used again when
+        # it renders again)
+        if child.tag in dom.components:
+            new_component = dom.components[child.tag](
+                dom=dom,
+                content=content,
+                event_handlers=event_handlers,
+                attributes=attrs,
+                key=key,
+                nodes=child.children,
+            )
+        else:
+            new_component = VNode(child.tag, attrs)
+            new_component.content = content
+            new_component.event_handlers = event_handlers
+            new_component.children = child.children
+            new_component.key = key
+            new_component.top_custom_component = owner
+            new_component.binding = child.binding
+        new_component.parent = self
+        return new_component
+
+    def _match_children(self, new_children: list, previous_children: list) -> list:
+        """ Find the previous child for each of the new children. Keyed children
+        are matched by tag and key, the other children by their position among
+        the unkeyed children.
+        """
+        keyed = {
+            (child.tag, child.key): index
+            for index, child in enumerate(previous_children)
+            if child.key is not None
+        }
+        unkeyed = iter(
+            [index for index, child in enumerate(previous_children) if child.key is None]
+        )
+
+        matches = []
+        for child in new_children:
+            if child.key is not None:
+                index = keyed.pop((child.tag, child.key), None)
+            else:
+                index = next(unkeyed, None)
+                if index is not None and previous_children[index].tag != child.tag:
+                    index = None
+            matches.append(index)
+        return matches
+
+    def _remove(self) -> None:
+
+        # Remove the element, and forget about it and all of its descendants
+        # once the removal is committed
+        nodes = self._subtree()
+        for node in nodes:
+            if node.binding is not None:
+                self.dom.replaced.add(node.binding)
+        self.dom.patches.append(["remove", self.node_id, [node.node_id for node in nodes]])
+        self.dom.defer(self._release, nodes)
+
+    def _subtree(self) -> list:
+        nodes = []
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.children)
+        return nodes
+
+    def _release(self, nodes: list) -> None:
+        for node in nodes:
+            self.dom.handlers.pop(node.node_id, None)
+            node._unmount()
+
+        # Break the references between the nodes, so nothing keeps the (parts
+        # of the) subtree alive
+        for node in nodes:
+            node.mounted = False
+            node.parent = None
+            node.children = []
+
+    def _reconcile_children(self, new_children: list, previous_children: list) -> Iterator[None]:
+
+        # Determine which previous child (if any) each new child replaces
+        matches = self._match_children(new_children, previous_children)
+
+        # Remove any children that aren't supposed to be there anymore
+        matched = set(index for index in matches if index is not None)
+        for index, child in enumerate(previous_children):
+            if index not in matched:
+                child._remove()
+
+        # Render the new nodes as children of this node (recursion), new
+        # elements are created detached and inserted below. Rendering can
+        # return the previous tree instead (for memoized components). Between
+        # children, the render yields when its time is up
+        dom = self.dom
+        hydrating = dom.hydrating
+        for i, index in enumerate(matches):
+            if dom.should_yield():
+                yield
+            new_children[i] = yield from new_children[i]._render(
+                parent_id=self.node_id if hydrating else None,
+                previous_tree=None if index is None else previous_children[index],
+                index=i if hydrating else None,
+            )
+
+        # Adopted elements are already in place
+        if hydrating:
+            return
+
+        # Children in the longest increasing run of previous positions keep
+        # their place, only the others are inserted (new) or moved
+        stable = _longest_increasing_subsequence(
+            [index for index in matches if index is not None]
+        )
+        anchor = None
+        for child, index in reversed(list(zip(new_children, matches))):
+            if index not in stable:
+                operation = "insert" if index is None else "move"
+                self.dom.patches.append([operation, child.node_id, self.node_id, anchor])
+            anchor = child.node_id
+
+    def render(
+        self,
+        parent_id: Optional[int],
+        previous_tree: Optional[ShadowNode] = None,
+        index: Optional[int] = None,
+    ) -> ShadowNode:
+        """ Render this node (and its descendants) in one go.
+        """
+        return _run(self._render(parent_id=parent_id, previous_tree=previous_tree, index=index))
+
+    def _render(
+        self,
+        parent_id: Optional[int],
+        previous_tree: Optional[ShadowNode] = None,
+        index: Optional[int] = None,
+    ) -> Iterator[None]:
+        """ Render this node as a unit of work: a generator that yields when the
+        render has to make way for the host, and returns the rendered node.
+        """
+
+        # If there was no previous item, create it
+        if previous_tree is None:
+            self._create_element(parent_id=parent_id, index=index)
+            previous_children = []
+
+        else:
+            self._adopt(previous_tree)
+
+            # Update event handlers
+            self._update_event_handlers(oldEvent_handlers=previous_tree.event_handlers)
+
+            # Update attributes
+            self._update_attributes(oldAttributes=previous_tree.attributes)
+
+            # Update the content (text)
+            self._update_content(oldContent=previous_tree.content)
+            previous_children = previous_tree.children
+
+        children = self._create_children()
+        if len(children) > 0 or len(previous_children) > 0:
+            yield from self._reconcile_children(children, previous_children)
+
+        # A node that renders in place keeps its children until the render is
+        # committed, it can still be abandoned
+        if previous_tree is self:
+            self.dom.defer(setattr, self, "children", children)
+        else:
+            self.children = children
+
+        # Rows bound to a list take over from the binding of the previous node
+        previous_binding = None if previous_tree is None else previous_tree.binding
+        if previous_binding is not None and previous_binding is not self.binding:
+            self.dom.replaced.add(previous_binding)
+        if self.binding is not None:
+            self.dom.defer(self.binding.attach, self, previous_binding)
+        elif previous_binding is not None:
+            self.dom.defer(previous_binding.detach)
+        self.mounted = True
+        return self
+
+    def _unmount(self) -> None:
+        pass
+
+    def is_mounted(self) -> bool:
+        """ Check if this node, and all of its ancestors, are still part of the
+        rendered tree.
+        """
+        node = self
+        while node is not None:
+            if not node.mounted:
+                return False
+            node = node.parent
+        return True
+
+
+class VNode(ShadowNode):
+    """ A lightweight node for a plain (HTML) element. The nodes are created by
+    rendering a template, and then used as the shadow of their element.
+    """
+
+    __slots__ = (
+        "tag",
+        "attributes",
+        "content",
+        "event_handlers",
+        "children",
+        "node_id",
+        "key",
+        "parent",
+        "mounted",
+        "top_custom_component",
+        "binding",
+    )
+
+    def __init__(self, tag: Optional[str], attributes: Dict[str, Any]) -> None:
+        self.tag = tag
+        self.attributes = attributes
+        self.content = None
+        self.event_handlers = {}
+        self.children = []
+        self.node_id = None
+        self.key = None
+        self.parent = None
+        self.mounted = False
+        self.top_custom_component = None
+        self.binding = None
+
+    @property
+    def dom(self) -> Dom:
+        return self.top_custom_component.dom
+
+    def _child_nodes(self) -> list:
+        return self.children
+
+    def _unmount(self) -> None:
+        if self.binding is not None:
+            self.binding.detach()
+
+
+class ListBinding:
+    """ A {% for %} loop over an observable list, that renders one row per item
+    and is the only content of its element. The changes of the list are
+    applied to the rows directly: a row is created, rendered again or
+    removed, without rendering the template or diffing the other rows.
+    """
+
+    __slots__ = ("items", "row", "key", "node", "version", "changes")
+
+    def __init__(self, items: ObservableList, row: Callable[[Any], list], key: str) -> None:
+        self.items = items
+        self.row = row
+        self.key = key
+        self.node = None
+
+        # The version of the list that the rows are rendered from, and the
+        # changes since then
+        self.version = items.version
+        self.changes = []
+
+    def attach(self, node: VNode, previous: Optional[ListBinding]) -> None:
+        """ Receive the changes to the list, once the rows are committed (in
+        place of the binding of the previous render).
+        """
+        self.node = node
+        if previous is not None and previous is not self:
+            previous.node = None
+
+            # Changes made since the rows were rendered still have to be applied
+            self.changes = [change for change in previous.changes if change[0] > self.version]
+        node.top_custom_component._state.bindings[self.key] = self
+        if len(self.changes) > 0:
+            node.dom.invalidate_binding(self)
+
+    def detach(self) -> None:
+        if self.node is not None:
+            bindings = self.node.top_custom_component._state.bindings
+            if bindings.get(self.key) is self:
+                del bindings[self.key]
+            self.node = None
+
+    def _render_row(self, item: Any) -> Iterator[None]:
+        row = self.node._create_child(self.row(item)[0])
+        return (yield from row._render(parent_id=None))
+
+    def _render(self) -> Iterator[None]:
+        node = self.node
+        dom = node.dom
+        changes = list(self.changes)
+        version = self.version
+
+        # Work on a copy of the rows, the render can still be abandoned
+        children = list(node.children)
+        for change_version, operation, index, item in changes:
+            if change_version <= version:
+                continue
+            version = change_version
+            if dom.should_yield():
+                yield
+            if operation == "insert":
+                row = yield from self._render_row(item)
+                anchor = children[index].node_id if index < len(children) else None
+                dom.patches.append(["insert", row.node_id, node.node_id, anchor])
+                children.insert(index, row)
+            elif operation == "remove":
+                children.pop(index)._remove()
+            elif operation == "set":
+
+                # Diff the row against the previous one, if it is the same element
+                previous = children[index]
+                row = node._create_child(self.row(item)[0])
+                if row.tag == previous.tag and row.key == previous.key:
+                    children[index] = yield from row._render(parent_id=None, previous_tree=previous)
+                else:
+                    previous._remove()
+                    children[index] = yield from row._render(parent_id=None)
+                    anchor = children[index + 1].node_id if index + 1 < len(children) else None
+                    dom.patches.append(["insert", row.node_id, node.node_id, anchor])
+            else:
+
+                # Render all rows again, and diff them with the current ones
+                rows = [node._create_child(row) for item in self.items for row in self.row(item)]
+                yield from node._reconcile_children(rows, children)
+                children = rows
+                version = self.items.version
+        dom.defer(self._applied, children, version, len(changes))
+
+    def _applied(self, children: list, version: int, count: int) -> None:
+        self.node.children = children
+        self.version = version
+        del self.changes[:count]
+
+
+class TemplateParser(HTMLParser):
+    """ Parse rendered HTML into a tree of virtual nodes. Only elements and
+    their text are kept, comments and declarations are dropped.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.root = VNode(None, {})
+        self.stack = [self.root]
+
+    def _add_node(self, tag: str, attrs: list) -> VNode:
+        node = VNode(
+            tag, {key: "" if value is None else value for key, value in attrs}
+        )
+        self.stack[-1].children.append(node)
+        return node
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        node = self._add_node(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(node)
+
+    def handle_startendtag(self, tag: str, attrs: list) -> None:
+        self._add_node(tag, attrs)
+
+    def handle_endtag(self, tag: str) -> None:
+
+        # Close the nearest open element with this tag, ignore stray end tags
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].tag == tag:
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data: str) -> None:
+        node = self.stack[-1]
+        node.content = data if node.content is None else node.content + data
+
+
+def parse_template(html: str) -> list:
+    """ Parse rendered HTML into a list of (top level) virtual nodes.
+    """
+    parser = TemplateParser()
+    parser.feed(html)
+    parser.close()
+    return parser.root.children
+
+
+class TemplateCompileError(Exception):
+    """ Raised when a template uses constructs the compiled engine does not
+    support. Components fall back to the Jinja engine for such templates.
+    """
+
+
+class Undefined:
+    """ The value of a name that is not in the template context. It renders
+    as an empty string, is falsy and iterates as an empty sequence.
+    """
+
+    def __str__(self) -> str:
+        return ""
+
+    def __bool__(self) -> bool:
+        return False
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self) -> int:
+        return 0
+
+    def __repr__(self) -> str:
+        return "Undefined"
+
+
+UNDEFINED = Undefined()
+
+
+def _str(value: Any) -> str:
+    return "" if value is UNDEFINED else str(value)
+
+
+def _getattr(value: Any, name: str) -> Any:
+
+    # Like Jinja, fall back to item lookup if there is no such attribute
+    try:
+        return getattr(value, name)
+    except AttributeError:
+        try:
+            return value[name]
+        except (TypeError, LookupError):
+            return UNDEFINED
+
+
+def _getitem(value: Any, key: Any) -> Any:
+    try:
+        return value[key]
+    except (TypeError, LookupError):
+        if isinstance(key, str):
+            return getattr(value, key, UNDEFINED)
+        return UNDEFINED
+
+
+def _bind_list(node: VNode, items: Any, row: Callable[[Any], list], key: str) -> None:
+
+    # Render the rows of the loop, bound to the items if they are observable
+    if isinstance(items, ObservableList):
+        node.binding = ListBinding(items, row, key)
+    for item in items:
+        node.children.extend(row(item))
+
+
+def _add_text(node: VNode, text: str) -> None:
+    if text != "":
+        node.content = text if node.content is None else node.content + text
+
+
+def _default(value: Any, default: Any = "", boolean: bool = False) -> Any:
+    if value is UNDEFINED or (boolean and not value):
+        return default
+    return value
+
+
+def _int(value: Any, default: int = 0, base: int = 10) -> int:
+
+    # Like Jinja, go through float for strings like "3.5", and use the default
+    # for anything that isn't a number
+    try:
+        if isinstance(value, str):
+            return int(value, base)
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return default
+
+
+def _float(value: Any, default: float = 0.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# The filters and tests that compiled templates support. Templates that use
+# others (like safe, since the text of compiled templates is never parsed as
+# HTML) fall back to Jinja
+TEMPLATE_FILTERS = {
+    "abs": abs,
+    "capitalize": lambda value: _str(value).capitalize(),
+    "count": len,
+    "d": _default,
+    "default": _default,
+    "e": _str,
+    "escape": _str,
+    "first": lambda value: next(iter(value), UNDEFINED),
+    "float": _float,
+    "int": _int,
+    "items": lambda value: list(value.items()),
+    "join": lambda value, separator="": separator.join(_str(x) for x in value),
+    "last": lambda value: value[-1] if len(value) > 0 else UNDEFINED,
+    "length": len,
+    "list": list,
+    "lower": lambda value: _str(value).lower(),
+    "reverse": lambda value: list(reversed(list(value))),
+    "string": _str,
+    "title": lambda value: _str(value).title(),
+    "trim": lambda value: _str(value).strip(),
+    "upper": lambda value: _str(value).upper(),
+}
+TEMPLATE_TESTS = {
+    "defined": lambda value: value is not UNDEFINED,
+    "undefined": lambda value: value is UNDEFINED,
+    "none": lambda value: value is None,
+    "even": lambda value: value % 2 == 0,
+    "odd": lambda value: value % 2 == 1,
+    "divisibleby": lambda value, number: value % number == 0,
+}
+
+
+class _Namespace:
+    """ The namespace() of Jinja, an object with attributes.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.__dict__.update(dict(*args, **kwargs))
+
+    def __repr__(self) -> str:
+        return f"<Namespace {self.__dict__!r}>"
+
+
+def _range(*args: int) -> range:
+
+    # Like Jinja, refuse ranges that are too long to render
+    result = range(*args)
+    if len(result) > 100000:
+        raise OverflowError("range too big, maximum size for range is 100000")
+    return result
+
+
+# The global functions of Jinja that compiled templates support, names in the
+# template context take precedence over them
+TEMPLATE_GLOBALS = {
+    "dict": dict,
+    "namespace": _Namespace,
+    "range": _range,
+}
+_UNSUPPORTED_GLOBALS = {"cycler", "joiner", "lipsum"}
+
+# Python operators for the Jinja expression nodes
+_BINARY_OPERATORS = {
+    "Add": "+", "Sub": "-", "Mul": "*", "Div": "/",
+    "FloorDiv": "//", "Mod": "%", "Pow": "**",
+}
+_COMPARE_OPERATORS = {
+    "eq": "==", "ne": "!=", "gt": ">", "gteq": ">=",
+    "lt": "<", "lteq": "<=", "in": "in", "notin": "not in",
+}
+
+# Markers that stand in for the Jinja syntax while parsing the HTML structure
+_TEMPLATE_TOKEN = re.compile(r"\{\{-?(.*?)-?\}\}|\{%-?(.*?)-?%\}|\{#.*?#\}", re.S)
+_EXPRESSION_MARKER = re.compile("\ue000(\\d+)\ue001")
+_BLOCK_TAGS = {"pydow-for", "pydow-if", "pydow-branch"}
+
+
+class _SourceParser(HTMLParser):
+    """ Parse template HTML into nested [tag, attrs, items] lists that keep
+    text and elements in their original order.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.root = [None, [], []]
+        self.stack = [self.root]
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        node = [tag, attrs, []]
+        self.stack[-1][2].append(node)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(node)
+
+    def handle_startendtag(self, tag: str, attrs: list) -> None:
+        self.stack[-1][2].append([tag, attrs, []])
+
+    def handle_endtag(self, tag: str) -> None:
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i][0] == tag:
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data: str) -> None:
+        items = self.stack[-1][2]
+        if len(items) > 0 and isinstance(items[-1], str):
+            items[-1] += data
+        else:
+            items.append(data)
+
+
+class TemplateCompiler:
+    """ Compile a template into the source of a Python function that builds
+    the virtual nodes directly, without rendering and parsing HTML. Supports
+    the subset of Jinja that components use: {{ expressions }}, {% for %}
+    and {% if %}/{% elif %}/{% else %}. Expressions are rendered as text,
+    values are not parsed as HTML.
+    """
+
+    def __init__(self, source: str) -> None:
+        from jinja2 import Environment
+
+        self.source = source
+        self.environment = Environment()
+        self.expressions = []
+        self.lines = []
+        self.counter = 0
+        self.scopes = []
+
+    def _parse(self, source: str) -> Any:
+        try:
+            return self.environment.parse(source).body[0]
+        except Exception as error:
+            raise TemplateCompileError(str(error)) from error
+
+    def _replace_token(self, match: re.Match, blocks: list) -> str:
+        expression, statement = match.group(1), match.group(2)
+
+        # Comments are dropped
+        if expression is None and statement is None:
+            return ""
+
+        # Expressions are replaced by a marker that survives HTML parsing
+        if expression is not None:
+            self.expressions.append(self._parse("{{ %s }}" % expression).nodes[0])
+            return "\ue000%d\ue001" % (len(self.expressions) - 1)
+
+        # Statements are replaced by (nested) block elements
+        keyword, _, rest = statement.strip().partition(" ")
+        if keyword == "for":
+            blocks.append("for")
+            self.expressions.append(self._parse("{%% %s %%}{%% endfor %%}" % statement))
+            return '<pydow-for n="%d">' % (len(self.expressions) - 1)
+        if keyword in ("if", "elif"):
+            if keyword == "if":
+                blocks.append("if")
+            elif len(blocks) == 0 or blocks[-1] != "if":
+                raise TemplateCompileError("elif outside of an if block")
+            self.expressions.append(self._parse("{%% if %s %%}{%% endif %%}" % rest).test)
+            marker = '<pydow-branch n="%d">' % (len(self.expressions) - 1)
+            return "<pydow-if>" + marker if keyword == "if" else "</pydow-branch>" + marker
+        if keyword == "else" and len(blocks) > 0 and blocks[-1] == "if":
+            return "</pydow-branch><pydow-branch>"
+        if keyword in ("endfor", "endif") and len(blocks) > 0 and blocks[-1] == keyword[3:]:
+            blocks.pop()
+            return "</pydow-for>" if keyword == "endfor" else "</pydow-branch></pydow-if>"
+        raise TemplateCompileError(f"unsupported statement: {statement.strip()}")
+
+    def compile(self) -> str:
+
+        # Replace the Jinja syntax by markers and parse the HTML structure
+        blocks = []
+        html = _TEMPLATE_TOKEN.sub(
+            lambda match: self._replace_token(match, blocks), self.source
+        )
+        if len(blocks) > 0:
+            raise TemplateCompileError(f"unclosed {blocks[-1]} block")
+        parser = _SourceParser()
+        parser.feed(html)
+        parser.close()
+
+        # Generate the render function
+        self.lines = ["def render(context):", "    root = VNode(None, {})"]
+        self._emit_items(parser.root[2], "root", None, 1)
+        self.lines.append("    return root.children")
+        return "\n".join(self.lines)
+
+    def _emit(self, line: str, indent: int) -> None:
+        self.lines.append("    " * indent + line)
+
+    def _emit_items(self, items: list, parent: str, text_target: Optional[str], indent: int) -> None:
+        for item in items:
+            if isinstance(item, str):
+                if text_target is not None:
+                    self._emit(f"_add_text({text_target}, {self._text(item)})", indent)
+                continue
+
+            tag, attrs, children = item
+            if tag == "pydow-for":
+                self._emit_for(item, parent, text_target, indent)
+            elif tag == "pydow-if":
+                self._emit_if(item, parent, text_target, indent)
+            elif tag in _BLOCK_TAGS:
+                raise TemplateCompileError("misplaced template block")
+            else:
+                self._emit_element(item, parent, indent)
+
+    def _emit_element(self, item: list, parent: str, indent: int) -> None:
+        tag, attrs, children = item
+        self.counter += 1
+        variable = f"n{self.counter}"
+
+        attributes = []
+        for key, value in attrs:
+            if "\ue000" in key or "<pydow-" in (value or ""):
+                raise TemplateCompileError(f"unsupported template syntax in <{tag}>")
+            attributes.append(f"{key!r}: {self._text('' if value is None else value)}")
+        self._emit(f"{variable} = VNode({tag!r}, {{{', '.join(attributes)}}})", indent)
+        self._emit(f"{parent}.children.append({variable})", indent)
+
+        # Loops over a list that make up the entire content are bound to it
+        loop = self._bindable_loop(children)
+        if loop is not None:
+            self._emit_bound_for(loop, variable, indent)
+            return
+
+        # Text is only used for elements without nested elements
+        has_elements = any(
+            isinstance(child, list) and child[0] not in _BLOCK_TAGS for child in children
+        )
+        self._emit_items(children, variable, None if has_elements else variable, indent)
+
+    def _bindable_loop(self, items: list) -> Optional[list]:
+        """ Get the loop that is the only content of an element, if it renders
+        a single element per item of a list that the template uses nowhere
+        else. Changes to that list can be applied to the rows directly.
+        """
+        blocks = [item for item in items if isinstance(item, list)]
+        if len(self.scopes) > 0 or len(blocks) != 1 or blocks[0][0] != "pydow-for":
+            return None
+        if any(isinstance(item, str) and item.strip() != "" for item in items):
+            return None
+        loop = self.expressions[int(dict(blocks[0][1])["n"])]
+        if loop.test is not None or loop.else_ or loop.recursive or type(loop.iter).__name__ != "Name":
+            return None
+        body = blocks[0][2]
+        rows = [item for item in body if isinstance(item, list)]
+        if len(rows) != 1 or rows[0][0] in _BLOCK_TAGS:
+            return None
+        if any(isinstance(item, str) and item.strip() != "" for item in body):
+            return None
+        from jinja2 import nodes
+
+        uses = sum(
+            1
+            for expression in self.expressions
+            for node in expression.find_all(nodes.Name)
+            if node.name == loop.iter.name and node.ctx == "load"
+        )
+        return blocks[0] if uses == 1 else None
+
+    def _loop_target(self, loop: Any) -> Tuple[Dict[str, str], str]:
+
+        # Loop variables are Python locals, unique per loop
+        self.counter += 1
+        names = {}
+        targets = loop.target.items if hasattr(loop.target, "items") else [loop.target]
+        for target in targets:
+            if not hasattr(target, "name"):
+                raise TemplateCompileError("unsupported loop target")
+            names[target.name] = f"l{self.counter}_{target.name}"
+        return names, ", ".join(names[target.name] for target in targets)
+
+    def _emit_bound_for(self, item: list, parent: str, indent: int) -> None:
+        loop = self.expressions[int(dict(item[1])["n"])]
+        names, target = self._loop_target(loop)
+
+        # The rows are rendered by a function per item, that renders later
+        # changes too
+        row = f"row{self.counter}"
+        argument = f"l{self.counter}" if "," in target else target
+        self._emit(f"def {row}({argument}):", indent)
+        if argument != target:
+            self._emit(f"{target} = {argument}", indent + 1)
+        self._emit(f"{row}_root = VNode(None, {{}})", indent + 1)
+        self.scopes.append(names)
+        self._emit_items(item[2], f"{row}_root", None, indent + 1)
+        self.scopes.pop()
+        self._emit(f"return {row}_root.children", indent + 1)
+        self._emit(
+            f"_bind_list({parent}, {self._expression(loop.iter)}, {row}, {loop.iter.name!r})",
+            indent,
+        )
+
+    def _emit_for(self, item: list, parent: str, text_target: Optional[str], indent: int) -> None:
+        loop = self.expressions[int(dict(item[1])["n"])]
+        if loop.else_ or loop.recursive:
+            raise TemplateCompileError("for-else and recursive loops are not supported")
+        names, target = self._loop_target(loop)
+        iterable = self._expression(loop.iter)
+
+        self.scopes.append(names)
+        self._emit(f"for {target} in {iterable}:", indent)
+        if loop.test is not None:
+            self._emit(f"if not ({self._expression(loop.test)}):", indent + 1)
+            self._emit("continue", indent + 2)
+        self._emit("pass", indent + 1)
+        self._emit_items(item[2], parent, text_target, indent + 1)
+        self.scopes.pop()
+
+    def _emit_if(self, item: list, parent: str, text_target: Optional[str], indent: int) -> None:
+        branches = [child for child in item[2] if isinstance(child, list)]
+        for i, branch in enumerate(branches):
+            n = dict(branch[1]).get("n")
+            if n is None:
+                self._emit("else:", indent)
+            else:
+                keyword = "if" if i == 0 else "elif"
+                self._emit(f"{keyword} {self._expression(self.expressions[int(n)])}:", indent)
+            self._emit("pass", indent + 1)
+            self._emit_items(branch[2], parent, text_target, indent + 1)
+
+    def _text(self, text: str) -> str:
+        """ Get a Python expression for text that may contain expression markers.
+        """
+        parts = []
+        for i, part in enumerate(_EXPRESSION_MARKER.split(text)):
+            if i % 2 == 0:
+                if part != "":
+                    parts.append(repr(part))
+            else:
+                parts.append(f"_str({self._expression(self.expressions[int(part)])})")
+        if len(parts) == 0:
+            return "''"
+        if len(parts) == 1:
+            return parts[0]
+        return f"''.join(({', '.join(parts)}))"
+
+    def _expression(self, node: Any) -> str:
+        """ Get a Python expression for a Jinja expression node.
+        """
+        kind = type(node).__name__
+        if kind == "Name":
+            for scope in reversed(self.scopes):
+                if node.name in scope:
+                    return scope[node.name]
+            if node.name == "loop" and len(self.scopes) > 0:
+                raise TemplateCompileError("the loop variable is not supported")
+            if node.name in _UNSUPPORTED_GLOBALS:
+                raise TemplateCompileError(f"unsupported global: {node.name}")
+            if node.name in TEMPLATE_GLOBALS:
+                return f"context.get({node.name!r}, _globals[{node.name!r}])"
+            return f"context.get({node.name!r}, UNDEFINED)"
+        if kind == "Const":
+            return repr(node.value)
+        if kind in ("List", "Tuple"):
+            items = ", ".join(self._expression(x) for x in node.items)
+            return f"[{items}]" if kind == "List" else f"({items},)"
+        if kind == "Dict":
+            items = ", ".join(
+                f"{self._expression(x.key)}: {self._expression(x.value)}" for x in node.items
+            )
+            return f"{{{items}}}"
+        if kind == "Getattr":
+            return f"_getattr({self._expression(node.node)}, {node.attr!r})"
+        if kind == "Getitem" and type(node.arg).__name__ != "Slice":
+            return f"_getitem({self._expression(node.node)}, {self._expression(node.arg)})"
+        if kind == "CondExpr":
+            otherwise = "UNDEFINED" if node.expr2 is None else self._expression(node.expr2)
+            return f"({self._expression(node.expr1)} if {self._expression(node.test)} else {otherwise})"
+        if kind in ("And", "Or"):
+            return f"({self._expression(node.left)} {kind.lower()} {self._expression(node.right)})"
+        if kind == "Not":
+            return f"(not {self._expression(node.node)})"
+        if kind in ("Neg", "Pos"):
+            return f"({'-' if kind == 'Neg' else '+'}{self._expression(node.node)})"
+        if kind in _BINARY_OPERATORS:
+            operator = _BINARY_OPERATORS[kind]
+            return f"({self._expression(node.left)} {operator} {self._expression(node.right)})"
+        if kind == "Concat":
+            return f"''.join(({', '.join(f'_str({self._expression(x)})' for x in node.nodes)},))"
+        if kind == "Compare":
+            expression = self._expression(node.expr)
+            for operand in node.ops:
+                if operand.op not in _COMPARE_OPERATORS:
+                    raise TemplateCompileError(f"unsupported operator: {operand.op}")
+                expression += f" {_COMPARE_OPERATORS[operand.op]} {self._expression(operand.expr)}"
+            return f"({expression})"
+        if kind in ("Call", "Filter", "Test"):
+            if node.dyn_args is not None or node.dyn_kwargs is not None:
+                raise TemplateCompileError("unsupported dynamic arguments")
+            arguments = [self._expression(x) for x in node.args] + [
+                f"{x.key}={self._expression(x.value)}" for x in node.kwargs
+            ]
+            if kind == "Call":
+                return f"{self._expression(node.node)}({', '.join(arguments)})"
+            functions = TEMPLATE_FILTERS if kind == "Filter" else TEMPLATE_TESTS
+            if node.node is None or node.name not in functions:
+                raise TemplateCompileError(f"unsupported {kind.lower()}: {node.name}")
+            arguments.insert(0, self._expression(node.node))
+            namespace = "_filters" if kind == "Filter" else "_tests"
+            return f"{namespace}[{node.name!r}]({', '.join(arguments)})"
+        raise TemplateCompileError(f"unsupported expression: {kind}")
+
+
+# The names that compiled render functions can use
+TEMPLATE_RUNTIME = {
+    "VNode": VNode,
+    "UNDEFINED": UNDEFINED,
+    "_str": _str,
+    "_getattr": _getattr,
+    "_getitem": _getitem,
+    "_add_text": _add_text,
+    "_bind_list": _bind_list,
+    "_filters": TEMPLATE_FILTERS,
+    "_tests": TEMPLATE_TESTS,
+    "_globals": TEMPLATE_GLOBALS,
+}
+
+
+def load_render_function(source: str) -> Callable[[Dict[str, Any]], list]:
+    """ Create a render function from the source produced by the compiler.
+    """
+    namespace = dict(TEMPLATE_RUNTIME)
+    exec(compile(source, "<template>", "exec"), namespace)
+    render = namespace["render"]
+    render.source = source
+    return render
+
+
+def compile_template(source: str) -> Optional[Callable[[Dict[str, Any]], list]]:
+    """ Compile a template into a render function that returns virtual nodes,
+    or None (with a warning) if the template is not supported by the compiler.
+    """
+    if Template is None:
+        raise ImportError(
+            "Jinja2 is required to compile templates that are not precompiled (see build.py)"
+        )
+    try:
+        return load_render_function(TemplateCompiler(source).compile())
+    except TemplateCompileError as error:
+        console.warn(f"Falling back to Jinja for template: {error}")
+        return None
+
+
+# Caches for the Jinja templates and the compiled render functions
+template_cache = TemplateCache()
+compiled_template_cache = TemplateCache(compile=compile_template)
+
+
+# Sequential identifiers for the custom components
+_identifiers = itertools.count()
+
+
+# Sequential identifiers for the DOM elements, used to refer to them in patches
+_node_ids = itertools.count()
+
+
+def _attribute_value(value: Union[str, list]) -> str:
+    return " ".join(value) if isinstance(value, list) else value
+
+
+def _shallow_equal(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """ Compare two dictionaries, by identity or equality of their values.
+    Persistent values are only compared by identity, since every change
+    creates a new version.
+    """
+    if a.keys() != b.keys():
+        return False
+    return all(
+        a[key] is b[key] or (not isinstance(a[key], Persistent) and a[key] == b[key])
+        for key in a
+    )
+
+
+def _same_nodes(a: Optional[list], b: Optional[list]) -> bool:
+    """ Compare the nodes that are handed down to a component by their tags,
+    attributes and text, since the parent creates them again at every render.
+    Bound lists always differ, their rows depend on the whole context.
+    """
+    if a is b:
+        return True
+    if a is None or b is None or len(a) != len(b):
+        return False
+    return all(
+        x.tag == y.tag
+        and x.content == y.content
+        and x.binding is None
+        and y.binding is None
+        and _shallow_equal(x.attributes, y.attributes)
+        and _same_nodes(x.children, y.children)
+        for x, y in zip(a, b)
+    )
+
+
+def _run(steps: Iterator[None]) -> Any:
+    """ Run a unit of work (see ShadowNode._render) to the end, and get its result.
+    """
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+def _longest_increasing_subsequence(sequence: list) -> set:
+    """ Get the values of the longest strictly increasing subsequence, in
+    O(n log n).
+    """
+    tails = []
+    predecessors = [-1] * len(sequence)
+    for i, value in enumerate(sequence):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if sequence[tails[middle]] < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low > 0:
+            predecessors[i] = tails[low - 1]
+        if low == len(tails):
+            tails.append(i)
+        else:
+            tails[low] = i
+
+    result = set()
+    i = tails[-1] if len(tails) > 0 else -1
+    while i >= 0:
+        result.add(sequence[i])
+        i = predecessors[i]
+    return result
+
+
+class TemplateContext(dict):
+    """ The variables of a template, that records which of them the template
+    reads while it renders.
+    """
+
+    def __init__(
+        self, *args, reads: Optional[set] = None, local: Iterable[str] = (), **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.reads = set() if reads is None else reads
+        self.local = frozenset(local)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.local:
+            self.reads.add(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key: str) -> bool:
+        if key not in self.local:
+            self.reads.add(key)
+        return super().__contains__(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in self.local:
+            self.reads.add(key)
+        return super().get(key, default)
+
+    def derive(self, **variables) -> TemplateContext:
+        """ Get a context with additional (local) variables, that records its
+        reads along with this one.
+        """
+        return TemplateContext(self, reads=self.reads, local=variables, **variables)
+
+
+def _render_jinja(template: Template, context: Dict[str, Any]) -> str:
+
+    # Use the context itself (instead of a copy) for the lookups of Jinja, so
+    # a TemplateContext records the reads
+    for key, value in template.globals.items():
+        if not dict.__contains__(context, key):
+            dict.__setitem__(context, key, value)
+    try:
+        return template.environment.concat(
+            template.root_render_func(template.new_context(context, shared=True))
+        )
+    except Exception:
+        template.environment.handle_exception()
+
+
+class ComponentRegistry:
+    """ The components by tag. Components register themselves when their class
+    is defined, their template is validated (and compiled) once, and their
+    scoped CSS is computed once, when it is first needed.
+    """
+
+    def __init__(self) -> None:
+        self.components = {}
+        self._css = {}
+        self._built_css = {}
+
+    def load(self, bundle: Dict[str, Any]) -> None:
+        """ Load the precompiled render functions and scoped CSS of a bundle
+        (created by build.py), before the components are defined.
+        """
+        for template, source in bundle["templates"].items():
+            compiled_template_cache.add(template, load_render_function(source))
+        for tag, css, scoped in bundle["css"]:
+            self._built_css[(tag, css)] = scoped
+
+    def register(self, component: Type[Component]) -> None:
+
+        # Compile the template, so errors surface when the class is defined
+        if component.template != "":
+            if component.template_engine == "compiled":
+                if compiled_template_cache.get(component.template) is None:
+                    template_cache.get(component.template)
+            else:
+                template_cache.get(component.template)
+        self.components[component.tag] = component
+        self._css.pop(component, None)
 
+    def css(self, component: Type[Component]) -> str:
+        """ Get the CSS of a component, scoped by prefixing the selectors with
+        the tag of the component.
+        """
+        css = self._css.get(component)
+        if css is None:
+            css = self._built_css.get((component.tag, component.css))
+        if css is None:
+            css = re.sub(
+                r"([^\r\n,{}\s]+)(,(?=[^}]*{)|\s*{)",
+                f"{component.tag} \\1 {{",
+                component.css,
+            )
+            lines = [line for line in css.split("\n") if line.rstrip() != ""]
+            css = "\n".join(lines)
+        self._css[component] = css
+        return css
 
-class DictDiffer:
-    """ Calculate the difference between 2 dictionaries.
-    """
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.components
 
-    def __init__(self, current_dict: Dict[str, Any], past_dict: Dict[str, Any]) -> None:
-        self.current_dict, self.past_dict = current_dict, past_dict
-        self.set_current, self.set_past = (
-            set(current_dict.keys()),
-            set(past_dict.keys()),
-        )
-        self.intersect = self.set_current.intersection(self.set_past)
+    def __getitem__(self, tag: str) -> Type[Component]:
+        return self.components[tag]
 
-    def added(self):
-        return self.set_current - self.intersect
+    def __len__(self) -> int:
+        return len(self.components)
 
-    def removed(self):
-        return self.set_past - self.intersect
 
-    def changed(self):
-        return set(
-            o for o in self.intersect if self.past_dict[o] != self.current_dict[o]
-        )
+# The registry of all components that are defined
+registry = ComponentRegistry()
 
 
 class State(MutableMapping):
-    """A dictionary that applies an arbitrary key-altering
-       function before accessing the keys"""
+    """ A dictionary that schedules a render of the DOM whenever it is
+    changed. Writes only mark the owning component as dirty, the render
+    itself is batched. Writes to state without an owner (the global state)
+    mark the components that read the written key as dirty.
+    """
 
-    def __init__(self, dom: Dom, *args, **kwargs):
+    def __init__(self, dom: Dom, *args, owner: Optional[Component] = None, **kwargs):
         self.initialized = False
         self.dom = dom
-        self.store = dict()
-        self.update(dict(*args, **kwargs))
+        self.owner = owner
+        self.store = dict(*args, **kwargs)
+        self.version = 0
+
+        # The global state keys that the owner read when it last rendered
+        self.reads = set()
+
+        # The loops of the owner that are bound to the lists in the state, by key
+        self.bindings = {}
+        for key, value in self.store.items():
+            if isinstance(value, ObservableList):
+                value._observe(self, key)
         self.initialized = True
 
     def __getitem__(self, key):
         return self.store[key]
 
     def __setitem__(self, key, value):
+
+        # Writing the same version of a persistent value changes nothing
+        previous = self.store.get(key)
+        if isinstance(value, (Persistent, ObservableList)) and previous is value:
+            return
+        if isinstance(previous, ObservableList):
+            previous._unobserve(self, key)
+        if isinstance(value, ObservableList):
+            value._observe(self, key)
         self.store[key] = value
+        self.version += 1
         if self.initialized:
-            self.dom.render()
+            self.dom.invalidate(self.owner, key)
 
     def __delitem__(self, key):
+        if isinstance(self.store[key], ObservableList):
+            self.store[key]._unobserve(self, key)
         del self.store[key]
+        self.version += 1
+        if self.initialized:
+            self.dom.invalidate(self.owner, key)
+
+    def changed(self, key: str, change: tuple) -> None:
+        """ Render a change to an observable list in the state, only in the
+        rows of the loops that are bound to it (if possible).
+        """
+        self.version += 1
         if self.initialized:
-            self.dom.render()
+            self.dom.invalidate(self.owner, key, change)
+
+    def update(self, *args, **kwargs) -> None:
+        if self.dom is None:
+            return super().update(*args, **kwargs)
+
+        # Coalesce all writes of the update into a single render
+        with self.dom.batch():
+            super().update(*args, **kwargs)
+
+    def release(self) -> None:
+        """ Detach the state from the DOM, when its owner is unmounted. Writes
+        (e.g. by a callback that still has the component) no longer render.
+        """
+        self.initialized = False
+        self.dom = None
+        self.owner = None
+        self.reads = set()
+        self.bindings = {}
+        for key, value in self.store.items():
+            if isinstance(value, ObservableList):
+                value._unobserve(self, key)
 
     def __iter__(self):
         return iter(self.store)
@@ -106,12 +2675,31 @@ class State(MutableMapping):
         return len(self.store)
 
 
-class Component:
+class Component(ShadowNode):
+    """ A custom component, defined by a template (and optionally CSS). Plain
+    elements in the template are rendered as (lightweight) virtual nodes.
+    """
 
     tag = ""
     template = ""
     css = ""
 
+    # Either "jinja", or "compiled" to build the nodes without rendering HTML
+    template_engine = "jinja"
+
+    # Skip rendering when the attributes and state are unchanged (see should_update)
+    memo = False
+
+    # Only the elements of a template are bound to lists (see ListBinding)
+    binding = None
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+
+        # Register the components that define a tag of their own
+        if cls.__dict__.get("tag", "") != "":
+            registry.register(cls)
+
     def __init__(
         self,
         dom,
@@ -121,23 +2709,38 @@ class Component:
         attributes: Dict[str, Any] = {},
         template: Optional[str] = None,
         top_custom_component: Optional[Component] = None,
+        key: Optional[str] = None,
+        nodes: Optional[list] = None,
     ) -> None:
 
         # Create a new unique identifier for this component
-        self.identifier = str(uuid.uuid4())
+        self.identifier = str(next(_identifiers))
 
         # Store a reference to the DOM
         self.dom = dom
 
         # Initialize other attributes (empty by default)
-        self.element = None
+        self.node_id = None
+        self.parent = None
+        self.mounted = False
         self.children = []
         self.content = content
+        self.key = key
+        self.nodes = nodes
         self.event_handlers = event_handlers
         self.attributes = attributes
+        self._tasks = set()
 
-        # Create a store for maintaining the state of this component
-        self._state = State(dom=self.dom, **getattr(self, "initial_state", {}))
+        # Create a store for maintaining the state of this component (with
+        # copies of observable lists, those are changed in place)
+        self._state = State(
+            dom=self.dom,
+            owner=self,
+            **{
+                key: value.copy() if isinstance(value, ObservableList) else value
+                for key, value in getattr(self, "initial_state", {}).items()
+            },
+        )
 
         # Get a reference to the closesed custom defined component
         if top_custom_component is None:
@@ -151,25 +2754,52 @@ class Component:
                 self.template = template
             else:
                 self.template = ""
-        self._template = Template(self.template)
+        self._template = None
+        self._render_nodes = None
+        if self.template != "":
+            if self.template_engine == "compiled":
+                self._render_nodes = compiled_template_cache.get(self.template)
+            if self._render_nodes is None:
+                self._template = template_cache.get(self.template)
 
         # Set the (HTML)tag of this component
         if tag is not None:
             self.tag = tag
 
     def get_element_by_id(self, identifier: str) -> JsProxy:
-        return document.querySelector(
+        return self.dom.backend.document.querySelector(
             f'{self.tag}[identifier="{self.identifier}"] #{identifier}'
         )
 
     def query_selector(self, query: str):
-        return document.querySelector(
+        return self.dom.backend.document.querySelector(
             f'{self.tag}[identifier="{self.identifier}"] {query}'
         )
 
     def on_mount(self):
         pass
 
+    def on_unmount(self):
+        """ Runs when the component is removed from the DOM (its element is
+        already detached). Release anything that on_mount acquired here.
+        """
+        pass
+
+    def should_update(
+        self,
+        old_attributes: Dict[str, Any],
+        new_attributes: Dict[str, Any],
+        old_state: Dict[str, Any],
+        new_state: Dict[str, Any],
+    ) -> bool:
+        """ Decide if a memoized component has to render again, when its parent
+        renders. By default the attributes and state are compared shallowly.
+        """
+        return not (
+            _shallow_equal(old_attributes, new_attributes)
+            and _shallow_equal(old_state, new_state)
+        )
+
     @property
     def state(self) -> Any:
         return self._state
@@ -190,252 +2820,834 @@ class Component:
     def get_global_state(self, key: str, default: Optional[Any] = None) -> Any:
         return self.dom.state.get(key, default)
 
-    def render_template(self) -> str:
-        state = {
-            **self.dom.state,
-            **dict(self.top_custom_component._state),
-        }
-        return self._template.render(**state)
+    def template_context(self) -> Dict[str, Any]:
+        return TemplateContext(
+            {
+                **self.dom.state,
+                **dict(self.top_custom_component._state),
+            }
+        )
+
+    def render_template(self, context: Optional[Dict[str, Any]] = None) -> str:
+        return _render_jinja(
+            self._template, self.template_context() if context is None else context
+        )
+
+    def _child_nodes(self) -> list:
 
-    def _set_attribute(self, attribute: str, value: Union[str, list]):
-        if isinstance(value, list):
-            self.element.setAttribute(attribute, " ".join(value))
+        # Only components with a template of their own render it, others get
+        # their part of the already rendered template handed down
+        if self._render_nodes is None and self._template is None:
+            return self.nodes or []
+        profiler = self.dom.profiler
+        context = self.template_context()
+        if self._render_nodes is not None:
+            if profiler is None:
+                nodes = self._render_nodes(context)
+            else:
+                start = time.perf_counter()
+                nodes = self._render_nodes(context)
+                profiler.add_template_time(self, time.perf_counter() - start, 0.0)
+        elif profiler is None:
+            nodes = parse_template(self.render_template(context))
         else:
-            self.element.setAttribute(attribute, value)
+            start = time.perf_counter()
+            html = self.render_template(context)
+            rendered = time.perf_counter()
+            nodes = parse_template(html)
+            profiler.add_template_time(
+                self, rendered - start, time.perf_counter() - rendered
+            )
 
-    def _create_element(self, parent_element: JsProxy) -> JsProxy:
+        # Render again when the global state that was read changes (once the
+        # render is committed, it can still be abandoned)
+        self.dom.defer(self.dom.track, self, context)
+        return nodes
 
-        # Create a DOM element to represent this object
-        self.element = document.createElement(self.tag)
-        if self.top_custom_component == self:
-            self.element.setAttribute("identifier", self.identifier)
+    def _create_element(self, parent_id: Optional[int], index: Optional[int] = None) -> None:
+        super()._create_element(parent_id=parent_id, index=index)
+        self.dom.patches.append(["setAttr", self.node_id, "identifier", self.identifier])
 
-        # Set attributes
-        for attribute, value in self.attributes.items():
-            self._set_attribute(attribute, value)
+        # Add the CSS of the component when it is first mounted (server rendered
+        # HTML contains the CSS already)
+        if self.tag not in self.dom.styled:
+            css = self.dom.styled[self.tag] = registry.css(type(self))
+            if css != "" and not self.dom.hydrating:
+                self.dom.patches.append(["style", self.tag, css])
 
-        # Add the element to its parent
-        if parent_element is not None:
-            parent_element.appendChild(self.element)
+        # Run the onMount function of the component, once it is committed
+        self.dom.mounting.append(self)
 
-        # Create event listeners
-        for event, handler in self.event_handlers.items():
-            self.element.addEventListener(event, handler)
+    def _needs_update(self, previous_tree: Component) -> bool:
 
-        # Add any content (text)
-        if self.content is not None:
-            self.element.appendChild(document.createTextNode(self.content))
+        # Components with written state, or written global state that they
+        # read, always update
+        if previous_tree in self.dom.rendering:
+            return True
+        if self.content != previous_tree.content:
+            return True
+        if not _same_nodes(self.nodes, previous_tree.nodes):
+            return True
+        return self.should_update(
+            previous_tree.attributes,
+            self.attributes,
+            previous_tree._rendered_state,
+            dict(previous_tree._state),
+        )
 
-        # Run the onMount function of the component
-        self.on_mount()
+    def _render(
+        self,
+        parent_id: Optional[int],
+        previous_tree: Optional[Component] = None,
+        index: Optional[int] = None,
+    ) -> Iterator[None]:
 
-    def _update_event_handlers(self, oldEvent_handlers: Dict[str, Callable]) -> None:
+        # Reuse the previous tree of memoized components that didn't change,
+        # with the parent and event handlers of this one (once committed)
+        profiler = self.dom.profiler
+        if (
+            self.memo
+            and previous_tree is not None
+            and previous_tree is not self
+            and not self._needs_update(previous_tree)
+        ):
+            self.node_id = previous_tree.node_id
+            self._update_event_handlers(oldEvent_handlers=previous_tree.event_handlers)
+            self.dom.defer(previous_tree._reuse, self)
+            if profiler is not None:
+                profiler.skip_render(self)
 
-        # Check which event handlers have changed, and update accordingly
-        diff = DictDiffer(self.event_handlers, oldEvent_handlers)
-        for key in diff.added():
-            self.element.addEventListener(key, self.event_handlers[key])
-        for key in diff.changed():
-            self.element.removeEventListener(key, oldEvent_handlers[key])
-            self.element.addEventListener(key, self.event_handlers[key])
-        for key in diff.removed():
-            self.element.removeEventListener(key, oldEvent_handlers[key])
-        self.event_handlers = {**oldEvent_handlers, **self.event_handlers}
+            # Components inside the previous tree can have written state too,
+            # those are rendered in place
+            for component in self.dom._dirty_descendants(previous_tree):
+                yield from component._render(parent_id=None, previous_tree=component)
+            return previous_tree
 
-    def _update_attributes(self, oldAttributes: Dict[str, Any]) -> None:
+        if profiler is None:
+            yield from super()._render(
+                parent_id=parent_id, previous_tree=previous_tree, index=index
+            )
+        else:
+            profiler.start_render(self)
+            try:
+                yield from super()._render(
+                    parent_id=parent_id, previous_tree=previous_tree, index=index
+                )
+            finally:
+                profiler.end_render(self)
+        if self.memo:
+            if previous_tree is self:
+                self.dom.defer(setattr, self, "_rendered_state", dict(self._state))
+            else:
+                self._rendered_state = dict(self._state)
+        return self
 
-        # Check which attributes have changed, and update accordingly
-        diff = DictDiffer(self.attributes, oldAttributes)
-        for key in diff.added():
-            self._set_attribute(key, self.attributes[key])
-        for key in diff.changed():
-            self._set_attribute(key, self.attributes[key])
-        for key in diff.removed():
-            self.element.removeAttribute(key)
-        self.attributes = {**oldAttributes, **self.attributes}
-
-    def _update_content(self):
-
-        # Get the desired content of this element (should always be a string)
-        content = "" if self.content is None else self.content
-
-        # Get the current content from the element, use a special filter to only get text of this element, not the children
-        current_content = "".join(
-            (
-                list(
-                    map(
-                        lambda element: element.textContent,
-                        filter(
-                            lambda element: element.nodeType == Node.TEXT_NODE,
-                            self.element.childNodes,
-                        ),
-                    )
+    def _reuse(self, node: Component) -> None:
+        self.parent = node.parent
+        self.event_handlers = node.event_handlers
+        if len(self.event_handlers) > 0:
+            self.dom.handlers[self.node_id] = self
+
+    def _adopt(self, previous_tree: Component) -> None:
+
+        # Copy the info from the previous component, since they are the same
+        self.identifier = previous_tree.identifier
+        self.node_id = previous_tree.node_id
+        self._state = previous_tree._state
+        self._tasks = previous_tree._tasks
+
+        # Writes to the state mark this component as dirty, once committed
+        self.dom.defer(setattr, self._state, "owner", self)
+
+    def create_task(self, coroutine: Awaitable[Any]) -> asyncio.Task:
+        """ Run a coroutine as long as the component is mounted, it is cancelled
+        when the component is removed. Writes to the state are rendered in the
+        next animation frame, so writes between awaits are coalesced.
+        """
+        task = self.dom.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+            console.error(
+                "".join(traceback.format_exception(type(error), error, error.__traceback__))
+            )
+
+    def _unmount(self) -> None:
+
+        # Stop the tasks of the component, so they don't write to its state,
+        # and stop rendering it for the global state
+        for task in list(self._tasks):
+            task.cancel()
+        self.dom.untrack(self)
+        result = self.on_unmount()
+        if inspect.iscoroutine(result):
+            self.dom.create_task(result)
+
+        # Drop the references to the DOM, the template and the nodes
+        self._state.release()
+        self._template = None
+        self._render_nodes = None
+        self.nodes = None
+        self.event_handlers = {}
+        self.dom.mounted_components -= 1
+
+
+class VirtualList(Component):
+    """ A list that only renders the rows in its viewport (plus a few rows of
+    overscan), so the cost of a render depends on the height of the viewport
+    instead of the number of items. Subclass it with a tag, a row template
+    (rendered with item and index) and a row height:
+
+        class TodoList(VirtualList):
+            tag = "todo-list"
+            row_template = "<p>{{ item.title }}</p>"
+            row_height = 40
+
+    The items are the "items" of the (component or global) state, none if
+    neither has them. Override get_items to use others.
+    Override estimate_row_height for rows of different heights. Row elements
+    are recycled while scrolling, so the row template shouldn't use keys.
+    """
+
+    row_template = ""
+    row_height = 30
+    height = 400
+    overscan = 5
+    memo = True
+    template_engine = "compiled"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._row_render = None
+        self._row_template = None
+        if self.row_template != "":
+            if self.template_engine == "compiled":
+                self._row_render = compiled_template_cache.get(self.row_template)
+            if self._row_render is None:
+                self._row_template = template_cache.get(self.row_template)
+        self._offsets = None
+        self._offsets_of = None
+        self._pool = 0
+        self._range = None
+
+    def get_items(self, context: Dict[str, Any]) -> list:
+        return context.get("items", [])
+
+    def estimate_row_height(self, index: int, item: Any) -> float:
+        return self.row_height
+
+    def _row_offsets(self, items: list) -> Optional[list]:
+
+        # Rows of a fixed height don't need offsets, others have the offsets
+        # of the rows computed once per list of items
+        if type(self).estimate_row_height is VirtualList.estimate_row_height:
+            return None
+        if self._offsets_of != (id(items), len(items)):
+            self._offsets = list(
+                itertools.accumulate(
+                    (self.estimate_row_height(i, item) for i, item in enumerate(items)),
+                    initial=0,
                 )
             )
+            self._offsets_of = (id(items), len(items))
+        return self._offsets
+
+    def _visible_range(self, items: list, scroll_top: float) -> Tuple[int, int]:
+        offsets = self._row_offsets(items)
+        if offsets is None:
+            first = int(scroll_top // self.row_height)
+            last = math.ceil((scroll_top + self.height) / self.row_height)
+        else:
+            first = bisect.bisect_right(offsets, scroll_top) - 1
+            last = bisect.bisect_left(offsets, scroll_top + self.height)
+        return max(0, first - self.overscan), min(len(items), last + self.overscan)
+
+    def _render_row(self, context: Dict[str, Any]) -> list:
+        if self._row_render is not None:
+            return self._row_render(context)
+        elif self._row_template is not None:
+            return parse_template(_render_jinja(self._row_template, context))
+        return []
+
+    def _child_nodes(self) -> list:
+        context = self.template_context()
+        items = self.get_items(context)
+        first, last = self._visible_range(items, self.state.get("scroll_top", 0))
+        self._range = (first, last)
+        offsets = self._row_offsets(items)
+        total = len(items) * self.row_height if offsets is None else offsets[-1]
+
+        # Rows are placed by their index modulo the size of the pool, so a row
+        # that scrolls out of view is reused for the row that scrolls into view
+        self._pool = max(self._pool, last - first)
+        rows = [None] * self._pool
+        for index in range(first, last):
+            if offsets is None:
+                top, height = index * self.row_height, self.row_height
+            else:
+                top, height = offsets[index], offsets[index + 1] - offsets[index]
+            row = VNode(
+                "div",
+                {
+                    "class": "pydow-row",
+                    "style": f"position: absolute; left: 0; right: 0; top: {top}px; height: {height}px;",
+                },
+            )
+            row.children = self._render_row(context.derive(item=items[index], index=index))
+            rows[index % self._pool] = row
+
+        # The viewport scrolls a spacer of the height of all rows
+        spacer = VNode("div", {"style": f"position: relative; height: {total}px;"})
+        spacer.children = [row for row in rows if row is not None]
+        viewport = VNode(
+            "div",
+            {
+                "class": "pydow-viewport",
+                "style": f"position: relative; overflow-y: auto; height: {self.height}px;",
+                "on:scroll": "_on_scroll",
+            },
         )
+        viewport.children = [spacer]
+        self.dom.defer(self.dom.track, self, context)
+        return [viewport]
+
+    def _on_scroll(self, event: JsProxy) -> None:
+
+        # Only render when other rows scroll into view
+        scroll_top = event.target.scrollTop
+        items = self.get_items(self.template_context())
+        if self._visible_range(items, scroll_top) != self._range:
+            self.state["scroll_top"] = scroll_top
+
+    def _adopt(self, previous_tree: Component) -> None:
+        super()._adopt(previous_tree)
+        self._offsets = previous_tree._offsets
+        self._offsets_of = previous_tree._offsets_of
+        self._pool = previous_tree._pool
+        self._range = previous_tree._range
 
-        # If the content changed, update the element
-        if current_content != content:
-            self.element.textContent = self.content
-
-    def _create_children(self):
-
-        # Parse the template of the component to create nested components
-        sub_template = BeautifulSoup(self.render_template())
-        children = sub_template.find_all(recursive=False)
-        new_children = []
-        if len(children) > 0:
-
-            # Loop the children from the template
-            for i in range(len(children)):
-                child = children[i]
-
-                if isinstance(child, Tag):
-
-                    # Get the attributes
-                    attrs = dict(
-                        {
-                            key: value
-                            for key, value in getattr(child, "attrs", {}).items()
-                            if not key.startswith("on:")
-                        }
-                    )
-
-                    # Extract event handlers
-                    event_handlers = {
-                        key[3:]: getattr(
-                            self.top_custom_component,
-                            value,
-                            lambda x: print("not implemented"),
-                        )
-                        for key, value in dict(getattr(child, "attrs", {})).items()
-                        if key.startswith("on:")
+
+# The events that don't bubble, their listener on the root captures them
+CAPTURED_EVENTS = {
+    "abort", "blur", "error", "focus", "load", "mouseenter", "mouseleave",
+    "pointerenter", "pointerleave", "scroll", "toggle",
+}
+
+
+# Applies a (JSON encoded) list of patches to the DOM of the browser, so a
+# render crosses the boundary between Python and JavaScript only once. Events
+# are delegated: there is a single listener per event type on the root, that
+# dispatches to the elements (from the target upwards) that listen for it. The
+# listener runs when the event bubbles up to the root (so listeners on the
+# elements themselves run first), or captures the events that don't bubble.
+# When hydrating, existing elements are adopted by their position in the parent
+# (or the first element with the tag, for the root) and mismatches are counted.
+# Destroying the applier removes the listeners, and forgets all elements
+JS_PATCH_APPLIER = """
+(dispatch, captured) => {
+    captured = new Set(JSON.parse(captured));
+    const nodes = new Map();
+    const handled = new Map();
+    const listeners = new Map();
+    let root = null;
+    const delegate = (type) => {
+        const listener = (event) => {
+            for (let element = event.target; element && element !== root; element = element.parentNode) {
+                const types = handled.get(element.__pydowId);
+                if (types !== undefined && types.has(type)) {
+                    dispatch(element.__pydowId, event);
+                    if (event.cancelBubble) break;
+                }
+                if (!event.bubbles) break;
+            }
+        };
+        listeners.set(type, listener);
+        root.addEventListener(type, listener, captured.has(type));
+    };
+    const destroy = () => {
+        for (const [type, listener] of listeners) root.removeEventListener(type, listener, captured.has(type));
+        listeners.clear();
+        handled.clear();
+        nodes.clear();
+    };
+    const adopt = (id, parent, index, tag, attributes, text) => {
+        if (parent === undefined) return false;
+        const children = Array.from(parent.children);
+        const element = index === null
+            ? children.find((child) => child.localName === tag)
+            : children[index];
+        if (element === undefined || element.localName !== tag) return false;
+        for (const name in attributes) {
+            if (element.getAttribute(name) !== attributes[name]) return false;
+        }
+        if (text !== null && element.children.length === 0 && element.textContent !== text) return false;
+        element.__pydowId = id;
+        nodes.set(id, element);
+        return true;
+    };
+    const apply = (json) => {
+        let mismatches = 0;
+        for (const patch of JSON.parse(json)) {
+            const node = nodes.get(patch[1]);
+            if (mismatches > 0 && node === undefined && patch[0] !== "adopt" && patch[0] !== "style") continue;
+            switch (patch[0]) {
+                case "query":
+                    root = document.querySelector(patch[2]);
+                    nodes.set(patch[1], root);
+                    break;
+                case "create":
+                    const element = document.createElement(patch[2]);
+                    element.__pydowId = patch[1];
+                    nodes.set(patch[1], element);
+                    break;
+                case "adopt":
+                    if (!adopt(patch[1], nodes.get(patch[2]), patch[3], patch[4], patch[5], patch[6])) mismatches++;
+                    break;
+                case "style":
+                    const style = document.createElement("style");
+                    style.setAttribute("data-pydow", patch[1]);
+                    style.textContent = patch[2];
+                    document.head.appendChild(style);
+                    break;
+                case "setAttr": node.setAttribute(patch[2], patch[3]); break;
+                case "removeAttr": node.removeAttribute(patch[2]); break;
+                case "setText": node.textContent = patch[2]; break;
+                case "insert":
+                case "move":
+                    nodes.get(patch[2]).insertBefore(node, patch[3] === null ? null : nodes.get(patch[3]));
+                    break;
+                case "remove":
+                    if (node !== undefined) node.remove();
+                    for (const id of patch[2]) {
+                        nodes.delete(id);
+                        handled.delete(id);
                     }
+                    break;
+                case "listen":
+                    if (!handled.has(patch[1])) handled.set(patch[1], new Set());
+                    handled.get(patch[1]).add(patch[2]);
+                    if (!listeners.has(patch[2])) delegate(patch[2]);
+                    break;
+                case "unlisten":
+                    handled.get(patch[1]).delete(patch[2]);
+                    if (handled.get(patch[1]).size === 0) handled.delete(patch[1]);
+                    break;
+            }
+        }
+        return mismatches;
+    };
+    const info = () => JSON.stringify({ elements: nodes.size, listening: handled.size, listeners: listeners.size });
+    return { apply: apply, element: (id) => nodes.get(id), info: info, destroy: destroy };
+}
+"""
 
-                    # Create a custom or default component
-                    if child.name in self.dom.components:
-                        new_component = self.dom.components[child.name](
-                            dom=self.dom,
-                            content=child.string,
-                            event_handlers=event_handlers,
-                            attributes=attrs,
-                            template=" ".join(
-                                [str(x) for x in child.find_all(recursive=False)]
-                            ),
-                        )
-                    else:
-                        new_component = Component(
-                            tag=child.name,
-                            dom=self.dom,
-                            content=child.string,
-                            event_handlers=event_handlers,
-                            attributes=attrs,
-                            template=" ".join(
-                                [str(x) for x in child.find_all(recursive=False)]
-                            ),
-                            top_custom_component=self.top_custom_component,
-                        )
-
-                    # Determine if there was already an item there
-                    if len(self.children) > i:
-                        previous = self.children[i]
-                    else:
-                        previous = None
 
-                    # Render the new component as a child of this component (recursion)
-                    new_component.render(
-                        parent_element=self.element, previous_tree=previous
-                    )
+class JsPatchApplier:
+    """ Commit patches to the DOM of the browser with a single call into JavaScript.
+    """
+
+    def __init__(self, dispatch: Callable[[int, JsProxy], None], window: JsProxy) -> None:
+        from pyodide.ffi import create_proxy  # type: ignore
 
-                    # Add it to the list for future reference
-                    new_children.append(new_component)
+        # The dispatch function is the only Python function that JavaScript
+        # holds on to, it lives until the applier is destroyed
+        self._dispatch = create_proxy(dispatch)
+        self._applier = window.eval(JS_PATCH_APPLIER)(
+            self._dispatch, json.dumps(sorted(CAPTURED_EVENTS))
+        )
 
-                else:
-                    raise Exception("child is not a Tag")
+    def apply(self, patches: list) -> int:
+        return self._applier.apply(json.dumps(patches))
 
-            # Remove any children that aren't supposed to be there anymore
-            for child in self.children[len(children) :]:
-                child.element.remove()
+    def element(self, node_id: int) -> JsProxy:
+        return self._applier.element(node_id)
 
-            # Set the children of this component, to the just created children
-            self.children = new_children
+    def info(self) -> Dict[str, int]:
+        info = json.loads(self._applier.info())
+        info["proxies"] = 0 if self._dispatch is None else 1
+        return info
 
-        # No children from the sub_template, remove any pre-existing children
-        else:
-            self.children = []
-            while self.element.lastElementChild is not None:
-                self.element.removeChild(self.element.lastElementChild)
+    def destroy(self) -> None:
+        if self._dispatch is not None:
+            self._applier.destroy()
+            self._dispatch.destroy()
+            self._dispatch = None
 
-        return new_children
 
-    def render(
-        self, parent_element: JsProxy, previous_tree: Optional[Component] = None
-    ) -> Component:
+class PatchApplier:
+    """ Commit patches to a DOM from Python, one call per operation. Useful to
+    inspect or test the patches without a browser.
+    """
 
-        # If there was no previous item, create it
-        if previous_tree is None:
-            self._create_element(parent_element=parent_element)
+    def __init__(self, dispatch: Callable[[int, JsProxy], None], document: Any) -> None:
+        self.dispatch = dispatch
+        self.document = document
+        self.root = None
+        self.nodes = {}
+        self.handled = {}
+        self.listeners = {}
+        self.mismatches = 0
+        self.operations = {
+            "query": self._query,
+            "create": self._create,
+            "adopt": self._adopt,
+            "style": self._style,
+            "setAttr": self._set_attribute,
+            "removeAttr": self._remove_attribute,
+            "setText": self._set_text,
+            "insert": self._insert,
+            "move": self._insert,
+            "remove": self._remove,
+            "listen": self._listen,
+            "unlisten": self._unlisten,
+        }
+
+    def apply(self, patches: list) -> int:
+        self.mismatches = 0
+        for patch in patches:
+
+            # Skip the elements that could not be adopted
+            if self.mismatches > 0 and patch[0] not in ("adopt", "style") and patch[1] not in self.nodes:
+                continue
+            self.operations[patch[0]](*patch[1:])
+        return self.mismatches
+
+    def element(self, node_id: int) -> Any:
+        return self.nodes.get(node_id)
+
+    def info(self) -> Dict[str, int]:
+
+        # The listeners are the functions that the browser would hold proxies of
+        return {
+            "elements": len(self.nodes),
+            "listening": len(self.handled),
+            "listeners": len(self.listeners),
+            "proxies": len(self.listeners),
+        }
+
+    def destroy(self) -> None:
+        for event, listener in self.listeners.items():
+            self.root.removeEventListener(event, listener, event in CAPTURED_EVENTS)
+        self.listeners = {}
+        self.handled = {}
+        self.nodes = {}
 
-        elif (
-            type(self) == type(previous_tree)
-            and self.__class__.__name__ == previous_tree.__class__.__name__
+    def _query(self, node_id: int, selector: str) -> None:
+        self.root = self.document.querySelector(selector)
+        self.nodes[node_id] = self.root
+
+    def _create(self, node_id: int, tag: str) -> None:
+        element = self.document.createElement(tag)
+        setattr(element, "__pydowId", node_id)
+        self.nodes[node_id] = element
+
+    def _adopt(
+        self,
+        node_id: int,
+        parent_id: int,
+        index: Optional[int],
+        tag: str,
+        attributes: Dict[str, str],
+        text: Optional[str],
+    ) -> None:
+
+        # Find the element at the position of the node, or the first element
+        # with the tag (for the root)
+        element = None
+        if parent_id in self.nodes:
+            children = list(self.nodes[parent_id].children)
+            if index is None:
+                element = next((c for c in children if c.localName == tag), None)
+            elif index < len(children):
+                element = children[index]
+        if element is None or element.localName != tag:
+            self.mismatches += 1
+            return
+
+        # The server may have rendered another state
+        if any(element.getAttribute(name) != value for name, value in attributes.items()) or (
+            text is not None and len(element.children) == 0 and element.textContent != text
         ):
+            self.mismatches += 1
+            return
+        setattr(element, "__pydowId", node_id)
+        self.nodes[node_id] = element
 
-            # Copy the info from the previous element, since they are the same
-            self.identifier = previous_tree.identifier
-            self.children = previous_tree.children
-            self.element = previous_tree.element
-            self._state = previous_tree._state
+    def _style(self, tag: str, css: str) -> None:
+        style = self.document.createElement("style")
+        style.setAttribute("data-pydow", tag)
+        style.textContent = css
+        self.document.head.appendChild(style)
 
-            # Update event handlers
-            self._update_event_handlers(oldEvent_handlers=previous_tree.event_handlers)
+    def _set_attribute(self, node_id: int, name: str, value: str) -> None:
+        self.nodes[node_id].setAttribute(name, value)
 
-            # Update attributes
-            self._update_attributes(oldAttributes=previous_tree.attributes)
+    def _remove_attribute(self, node_id: int, name: str) -> None:
+        self.nodes[node_id].removeAttribute(name)
 
-            # Update the content (text)
-            self._update_content()
+    def _set_text(self, node_id: int, text: Optional[str]) -> None:
+        self.nodes[node_id].textContent = text
 
-        self.children = self._create_children()
-        return self
+    def _insert(self, node_id: int, parent_id: int, before_id: Optional[int]) -> None:
+        before = None if before_id is None else self.nodes[before_id]
+        self.nodes[parent_id].insertBefore(self.nodes[node_id], before)
 
+    def _remove(self, node_id: int, node_ids: list) -> None:
 
-class Dom:
-    def __init__(self, root: Type[Component], selector: str) -> None:
-
-        # Gather all components that are defined in the global space
-        self.components = {
-            component.tag: component
-            for component in list(
-                [
-                    value
-                    for value in globals().values()
-                    if isinstance(value, type)
-                    and issubclass(value, Component)
-                    and value.__name__ != "Component"
-                ]
-            )
+        # Elements that were not adopted when hydrating are not there
+        if node_id in self.nodes:
+            self.nodes[node_id].remove()
+        for removed_id in node_ids:
+            self.nodes.pop(removed_id, None)
+            self.handled.pop(removed_id, None)
+
+    def _listen(self, node_id: int, event: str) -> None:
+        self.handled.setdefault(node_id, set()).add(event)
+        if event not in self.listeners:
+            listener = self.listeners[event] = lambda e: self._delegate(event, e)
+            self.root.addEventListener(event, listener, event in CAPTURED_EVENTS)
+
+    def _unlisten(self, node_id: int, event: str) -> None:
+        self.handled[node_id].discard(event)
+        if len(self.handled[node_id]) == 0:
+            del self.handled[node_id]
+
+    def _delegate(self, event_type: str, event: Any) -> None:
+
+        # Dispatch to the elements that handle the event, from the target up
+        element = event.target
+        while element is not None and element is not self.root:
+            node_id = getattr(element, "__pydowId", None)
+            if event_type in self.handled.get(node_id, ()):
+                self.dispatch(node_id, event)
+                if getattr(event, "cancelBubble", False):
+                    break
+            if not getattr(event, "bubbles", True):
+                break
+            element = element.parentNode
+
+
+class Profiler:
+    """ Records the renders of a Dom. Per component (tag) it counts the renders
+    and the time spent rendering the template, parsing it and diffing the
+    nodes. Per commit it records what triggered the render (the state keys
+    that were written) and the DOM operations. Subscribers are called with the
+    record of every commit.
+    """
+
+    def __init__(self) -> None:
+        self.subscribers = []
+        self.reset()
+
+    def reset(self) -> None:
+        self.components = {}
+        self.commits = 0
+        self.commit_time = 0.0
+        self.dom_operations = 0
+        self._triggers = []
+        self._rendered = {}
+        self._stack = []
+        self._suspended = None
+
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None]) -> Callable[[], None]:
+        """ Call a function with the record of every commit. Returns a function
+        that unsubscribes it again.
+        """
+        self.subscribers.append(callback)
+        return lambda: self.subscribers.remove(callback)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "components": {tag: dict(stats) for tag, stats in self.components.items()},
+            "commits": self.commits,
+            "commit_time": self.commit_time,
+            "dom_operations": self.dom_operations,
         }
 
-        # Gather all the CSS
-        self.css = []
-        for component in self.components.values():
-            if component.css != "":
+    def _stats(self, component: Component) -> Dict[str, Any]:
+        stats = self.components.get(component.tag)
+        if stats is None:
+            stats = self.components[component.tag] = {
+                "renders": 0,
+                "skipped": 0,
+                "template_time": 0.0,
+                "parse_time": 0.0,
+                "diff_time": 0.0,
+            }
+        return stats
 
-                # Scope the CSS by prefixing it with the component tag
-                css = re.sub(
-                    r"([^\r\n,{}\s]+)(,(?=[^}]*{)|\s*{)",
-                    f"{component.tag} \\1 {{",
-                    component.css,
-                )
-                lines = list([line for line in css.split("\n") if line.rstrip() != ""])
-                self.css.append("\n".join(lines))
+    def trigger(self, component: Optional[Component], key: Optional[str]) -> None:
+        self._triggers.append(
+            {
+                "component": None if component is None else component.tag,
+                "identifier": None if component is None else component.identifier,
+                "key": key,
+            }
+        )
+
+    def start_render(self, component: Component) -> None:
+
+        # Keep track of the time of nested renders and the template, so the
+        # time of the diff is only the time spent in the component itself
+        self._stack.append([time.perf_counter(), 0.0])
+
+    def end_render(self, component: Component) -> None:
+        start, excluded = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        if len(self._stack) > 0:
+            self._stack[-1][1] += elapsed
+        stats = self._stats(component)
+        stats["renders"] += 1
+        stats["diff_time"] += elapsed - excluded
+        self._rendered[component.tag] = self._rendered.get(component.tag, 0) + 1
+
+    def skip_render(self, component: Component) -> None:
+        self._stats(component)["skipped"] += 1
+
+    def suspend(self) -> None:
+        self._suspended = time.perf_counter()
+
+    def resume(self) -> None:
+
+        # Don't count the time the render was suspended (the host ran)
+        if self._suspended is not None:
+            suspended = time.perf_counter() - self._suspended
+            for entry in self._stack:
+                entry[0] += suspended
+            self._suspended = None
+
+    def add_template_time(self, component: Component, template: float, parse: float) -> None:
+        stats = self._stats(component)
+        stats["template_time"] += template
+        stats["parse_time"] += parse
+        if len(self._stack) > 0:
+            self._stack[-1][1] += template + parse
+
+    def record_commit(self, patches: list, commit_time: float) -> None:
+        operations = {}
+        for patch in patches:
+            operations[patch[0]] = operations.get(patch[0], 0) + 1
+        record = {
+            "triggers": self._triggers,
+            "rendered": self._rendered,
+            "dom_operations": len(patches),
+            "operations": operations,
+            "commit_time": commit_time,
+        }
+        self._triggers = []
+        self._rendered = {}
+        self.commits += 1
+        self.commit_time += commit_time
+        self.dom_operations += len(patches)
+        for callback in list(self.subscribers):
+            callback(record)
+
+
+# The priorities (lanes) of state updates, the most urgent first: updates in
+# event handlers (and batches) are rendered right away, other updates in the
+# next animation frames and updates in a transition after those
+SYNC_LANE = 0
+DEFAULT_LANE = 1
+TRANSITION_LANE = 2
+
+
+class RenderWork:
+    """ A render in progress: the dirty components of a lane, and the steps
+    that render them. The work can be suspended between the steps, and it is
+    either committed as a whole or abandoned.
+    """
+
+    __slots__ = ("lane", "dirty", "steps", "styled")
+
+    def __init__(self, lane: int, dirty: set, steps: Iterator[None], styled: Dict[str, str]) -> None:
+        self.lane = lane
+        self.dirty = dirty
+        self.steps = steps
+        self.styled = styled
+
+
+def _log_render(record: Dict[str, Any]) -> None:
+    """ Log the record of a commit in a (collapsed) console group.
+    """
+    with GroupedLogs(
+        f"PyDow render: {record['dom_operations']} DOM operations", closed=True
+    ):
+        for trigger in record["triggers"]:
+            console.log(
+                "Triggered by",
+                trigger["component"] or "global state",
+                trigger["key"],
+            )
+        for tag, renders in record["rendered"].items():
+            console.log("Rendered", tag, renders)
+        console.log("Commit", f"{record['commit_time'] * 1000:.2f} ms")
+
+
+class Dom:
+    def __init__(
+        self,
+        root: Type[Component],
+        selector: str,
+        backend: Optional[Union[BrowserBackend, HeadlessBackend]] = None,
+        mode: str = "render",
+    ) -> None:
+
+        # The DOM to render to, the browser or a headless one
+        self.backend = default_backend if backend is None else backend
+
+        # Render from scratch, hydrate server rendered HTML or render on the
+        # server (without running on_mount)
+        if mode not in ("render", "hydrate", "server"):
+            raise ValueError(f"Unknown render mode: {mode}")
+        self.mode = mode
+        self.hydrating = mode == "hydrate"
+
+        # The registered components, and the tags of which the CSS is added
+        self.components = registry
+        self.styled = {}
+
+        # The patches of the current render, and the applier that commits them.
+        # Changes to the handlers and the tree itself are also only made once
+        # the render is committed
+        self.applier = self.backend.create_applier(dispatch=self._dispatch_event)
+        self.patches = []
+        self.mounting = []
+        self.deferred = []
+
+        # The nodes with event handlers, by the id of their element
+        self.handlers = {}
+        self._handler_updates = {}
+
+        # The number of mounted components (to check for leaks)
+        self.mounted_components = 0
+
+        # The components that are rendered because their state was written, and
+        # the list bindings of which the rows are rendered again
+        self.rendering = set()
+        self.replaced = set()
+
+        # The states of the components that read a key of the global state (by
+        # their id), by key (None for components that read all of it)
+        self.readers = {}
+
+        # Profile the renders (when enabled, logged to the console when debugging)
+        self.profiler = None
+        if DEBUG:
+            self.start_profiling().subscribe(_log_render)
 
-        # Add the CSS to the head of the document
-        styleElement = document.createElement("style")
-        styleElement.type = "text/css"
-        styleElement.innerHTML = "\n".join(self.css)
-        document.head.appendChild(styleElement)
+        # Keep track of pending renders per lane, so state updates can be
+        # batched, and of the render in progress
+        self._batch_depth = 0
+        self._lane = DEFAULT_LANE
+        self._dirty = [set(), set(), set()]
+        self._work = None
+        self._deadline = None
+        self._frame_requested = False
 
         # Create the root component
         self.root = root(dom=self)
@@ -443,17 +3655,447 @@ class Dom:
         self.state = State(dom=self)
 
         # Find the root element in the document
-        self.element = document.querySelector(selector)
+        self.node_id = next(_node_ids)
+        self.patches.append(["query", self.node_id, selector])
 
         # Render the DOM, starting from the root component
         self.render()
+        self._schedule()
 
-    def render(self) -> None:
+    # The time (in milliseconds) that a render may take per animation frame,
+    # before it yields to the browser
+    frame_budget = 8.0
+
+    @contextmanager
+    def batch(self) -> Iterator[Dom]:
+        """ Group state updates, the DOM is rendered once when the outermost
+        batch exits (and only if any state was changed). Updates in a batch
+        are urgent, unless the batch is part of a transition.
+        """
+        self._batch_depth += 1
+        lane = self._lane
+        if lane == DEFAULT_LANE:
+            self._lane = SYNC_LANE
+        try:
+            yield self
+        finally:
+            self._lane = lane
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush(SYNC_LANE)
+                self._schedule()
+
+    @contextmanager
+    def transition(self) -> Iterator[Dom]:
+        """ Mark state updates as not urgent. They are rendered in slices of at
+        most frame_budget per animation frame, and more urgent updates (e.g.
+        user input) interrupt them.
+        """
+        lane, self._lane = self._lane, TRANSITION_LANE
+        try:
+            yield self
+        finally:
+            self._lane = lane
+
+    def _dispatch_event(self, node_id: int, event: JsProxy) -> None:
+
+        # Look up the current handler, all state updates it makes are batched
+        node = self.handlers.get(node_id)
+        if node is not None and event.type in node.event_handlers:
+            handler = node.event_handlers[event.type]
+            with self.batch():
+                result = handler(event)
+
+            # Run async handlers as a task of their component
+            if inspect.iscoroutine(result):
+                owner = getattr(handler, "__self__", None)
+                if isinstance(owner, Component):
+                    owner.create_task(result)
+                else:
+                    self.create_task(result)
+
+    def set_handler(self, node_id: int, node: Optional[ShadowNode]) -> None:
+        """ Dispatch the events of an element to a node (or to none), once the
+        render is committed.
+        """
+        self._handler_updates[node_id] = node
+
+    def defer(self, callback: Callable, *args) -> None:
+        """ Call a function once the render is committed (it is dropped when
+        the render is abandoned).
+        """
+        self.deferred.append((callback, args))
+
+    def should_yield(self) -> bool:
+        """ Check if the render in progress has to make way for the host.
+        """
+        return self._deadline is not None and self.backend.now() >= self._deadline
+
+    def track(self, component: Component, context: Dict[str, Any]) -> None:
+        """ Subscribe a component to the keys of the global state it read while
+        rendering (to all keys, if its context doesn't record the reads).
+        """
+        state = component._state
+        if not state.initialized:
+            return
+        reads = getattr(context, "reads", None)
+        if reads is None:
+            keys = {None}
+        else:
+            keys = set(key for key in reads if key not in state)
+        if keys == state.reads:
+            return
+        for key in state.reads - keys:
+            readers = self.readers[key]
+            del readers[id(state)]
+            if len(readers) == 0:
+                del self.readers[key]
+        for key in keys - state.reads:
+            self.readers.setdefault(key, {})[id(state)] = state
+        state.reads = keys
+
+    def untrack(self, component: Component) -> None:
+        state = component._state
+        for key in state.reads:
+            readers = self.readers[key]
+            del readers[id(state)]
+            if len(readers) == 0:
+                del self.readers[key]
+        state.reads = set()
+
+    def info(self) -> Dict[str, int]:
+        """ Count the live objects of the DOM: the mounted components, the
+        elements and the handlers, listeners and proxies of their events. Use
+        it to check for leaks, e.g. in tests.
+        """
+        return {
+            "components": self.mounted_components,
+            "handlers": len(self.handlers),
+            "readers": sum(len(readers) for readers in self.readers.values()),
+            **self.applier.info(),
+        }
+
+    def unmount(self) -> None:
+        """ Remove the app from the page: unmount all components (running their
+        on_unmount), and release the listeners and proxies of the events.
+        """
+        if self._work is not None:
+            self._abandon()
+        self._dirty = [set(), set(), set()]
+        if self.previous_tree is not None:
+            self.previous_tree._remove()
+            self.previous_tree = None
+            self.commit()
+        self.applier.destroy()
+
+    def _forget(self, tree: ShadowNode) -> None:
+
+        # Release a tree that was rendered but never mounted (the hydrated tree
+        # when it didn't match), so its components don't render again
+        nodes = tree._subtree()
+        self.patches.append(["remove", tree.node_id, [node.node_id for node in nodes]])
+        for node in nodes:
+            if isinstance(node, Component):
+                self.untrack(node)
+                node._state.release()
+            elif node.binding is not None:
+                node.binding.detach()
+        for node in nodes:
+            node.mounted = False
+            node.parent = None
+            node.children = []
+
+    def create_task(self, coroutine: Awaitable[Any]) -> asyncio.Task:
+        """ Run a coroutine on the asyncio loop of the backend. Its requests
+        (with fetch) are sent through the backend too.
+        """
+        token = _current_backend.set(self.backend)
+        try:
+            return self.backend.loop.create_task(coroutine)
+        finally:
+            _current_backend.reset(token)
+
+    def start_profiling(self) -> Profiler:
+        """ Record the renders, until profiling is stopped. Returns the
+        profiler, to subscribe to the renders or take a snapshot.
+        """
+        if self.profiler is None:
+            self.profiler = Profiler()
+        return self.profiler
+
+    def stop_profiling(self) -> Optional[Profiler]:
+        profiler, self.profiler = self.profiler, None
+        return profiler
+
+    def invalidate(
+        self,
+        component: Optional[Component] = None,
+        key: Optional[str] = None,
+        change: Optional[tuple] = None,
+    ) -> None:
+        """ Mark a component (or the entire DOM if no component is provided) as
+        dirty, in the lane of the update. Inside a batch the render is
+        postponed until the batch exits, otherwise it is scheduled for the next
+        animation frame. The key of the state that was written is recorded
+        when profiling. Changes to observable lists only mark the loops that
+        are bound to them.
+        """
+        if self.profiler is not None:
+            self.profiler.trigger(component, key)
+        dirty = self._dirty[self._lane]
+        if component is not None:
+            self._mark(dirty, component, key, change)
+        elif key is None:
+            dirty.add(self.root)
+        else:
+
+            # Only render the components that read the key of the global state
+            for readers in (self.readers.get(key, {}), self.readers.get(None, {})):
+                for state in readers.values():
+                    self._mark(dirty, state.owner, key, change)
+        self._schedule()
+
+    def _mark(self, dirty: set, component: Component, key: Optional[str], change: Optional[tuple]) -> None:
+
+        # Changes to a list that is bound to a loop only render its rows
+        binding = None if change is None else component._state.bindings.get(key)
+        if binding is None:
+            dirty.add(component)
+        else:
+            binding.changes.append(change)
+            dirty.add(binding)
+
+    def invalidate_binding(self, binding: ListBinding) -> None:
+        """ Render the pending changes of a list binding.
+        """
+        self._dirty[self._lane].add(binding)
+        self._schedule()
+
+    def _schedule(self) -> None:
+
+        # Updates that aren't urgent (and suspended work) are rendered in the
+        # next animation frame
+        if self._batch_depth > 0 or self._frame_requested:
+            return
+        if self._work is not None or any(len(dirty) > 0 for dirty in self._dirty):
+            self._frame_requested = True
+            self.backend.request_animation_frame(self._on_animation_frame)
 
-        # Render the root component
-        self.previous_tree = self.root.render(
-            parent_element=self.element, previous_tree=self.previous_tree
+    def _on_animation_frame(self, timestamp: float) -> None:
+        self._frame_requested = False
+        if self._batch_depth == 0:
+            self.flush(deadline=self.backend.now() + self.frame_budget)
+        self._schedule()
+
+    def flush(self, lane: int = TRANSITION_LANE, deadline: Optional[float] = None) -> bool:
+        """ Render the components that were marked as dirty (in the lanes up to
+        the given one), the most urgent lane first. When the deadline passes
+        (if any), the render is suspended. Returns if all work was done.
+        """
+        while True:
+            next_lane = next(
+                (i for i in range(lane + 1) if len(self._dirty[i]) > 0), None
+            )
+
+            # Continue the work in progress, unless there are more urgent updates
+            work = self._work
+            if work is not None and work.lane <= lane and (next_lane is None or work.lane <= next_lane):
+                pass
+            elif next_lane is None:
+                return True
+            else:
+                if work is not None:
+                    self._abandon()
+                self._start(next_lane)
+            if not self._perform(deadline):
+                return False
+
+    def _start(self, lane: int) -> None:
+
+        # Render the current instances of the dirty components (a parent may
+        # have rendered them again since they were marked)
+        units, self._dirty[lane] = self._dirty[lane], set()
+        bindings = [unit for unit in units if isinstance(unit, ListBinding)]
+        dirty = set(
+            unit._state.owner for unit in units if not isinstance(unit, ListBinding)
         )
+        dirty.discard(None)
+        self._work = RenderWork(
+            lane, dirty | set(bindings), self._render_steps(dirty, bindings), dict(self.styled)
+        )
+
+    def _render_steps(self, dirty: set, bindings: list) -> Iterator[None]:
+        self.rendering = dirty
+        self.replaced = set()
+        if self.root in dirty:
+            self.previous_tree = yield from self.root._render(
+                parent_id=self.node_id, previous_tree=self.previous_tree
+            )
+        else:
+
+            # Only render the subtrees of the dirty components, reuse the rest
+            for component in self._outermost(dirty):
+                yield from component._render(parent_id=None, previous_tree=component)
+
+        # Then apply the changes to the bound lists, unless their rows were
+        # rendered (or removed) with their component
+        for binding in bindings:
+            if binding.node is not None and binding not in self.replaced and binding.node.is_mounted():
+                yield from binding._render()
+
+    def _perform(self, deadline: Optional[float]) -> bool:
+
+        # Writes to the state while rendering (e.g. in on_mount) are batched,
+        # in the lane of the work
+        work = self._work
+        profiler = self.profiler
+        self._deadline = deadline
+        self._batch_depth += 1
+        lane, self._lane = self._lane, work.lane
+        if profiler is not None:
+            profiler.resume()
+        try:
+            next(work.steps)
+        except StopIteration:
+            self._work = None
+            self.commit()
+            return True
+        except BaseException:
+            self._discard()
+            raise
+        finally:
+            self._deadline = None
+            self._batch_depth -= 1
+            self._lane = lane
+        if profiler is not None:
+            profiler.suspend()
+        return False
+
+    def _abandon(self) -> None:
+
+        # Throw away the render in progress, its components are rendered again
+        # later (in their lane)
+        work = self._work
+        if self.profiler is not None:
+            self.profiler.resume()
+        work.steps.close()
+        self._dirty[work.lane] |= work.dirty
+        self.styled = work.styled
+        self._discard()
+
+    def _discard(self) -> None:
+        self._work = None
+        self.patches = []
+        self.mounting = []
+        self.deferred = []
+        self._handler_updates = {}
+
+    def _outermost(self, components: set) -> list:
+        """ Filter the components to the mounted ones that have no dirty ancestor,
+        since rendering an ancestor already renders its descendants.
+        """
+        outermost = []
+        for component in components:
+            if not component.is_mounted():
+                continue
+            parent = component.parent
+            while parent is not None and parent not in components:
+                parent = parent.parent
+            if parent is None:
+                outermost.append(component)
+        return outermost
+
+    def _dirty_descendants(self, tree: Component) -> list:
+        """ Find the components being rendered inside a tree that is reused,
+        except the ones with such an ancestor in the tree (rendering an
+        ancestor already renders its descendants).
+        """
+        descendants = []
+        for component in self.rendering:
+            parent = component.parent
+            while parent is not None and parent is not tree and parent not in self.rendering:
+                parent = parent.parent
+            if parent is tree and component.is_mounted():
+                descendants.append(component)
+        return descendants
+
+    def render_components(self, components: set) -> None:
+        """ Render components right away.
+        """
+        self._dirty[SYNC_LANE] |= set(components)
+        self.flush(SYNC_LANE)
+
+    def render(self) -> None:
+        """ Render the entire DOM right away.
+        """
+        self._dirty[SYNC_LANE].add(self.root)
+        self.flush(SYNC_LANE)
+
+    def commit(self) -> None:
+        """ Apply the patches of the render to the DOM, then run the on_mount
+        function of the newly created components.
+        """
+        patches, self.patches = self.patches, []
+        mounting, self.mounting = self.mounting, []
+        deferred, self.deferred = self.deferred, []
+        handler_updates, self._handler_updates = self._handler_updates, {}
+        profiler = self.profiler
+        start = time.perf_counter() if profiler is not None else 0.0
+        mismatches = self.applier.apply(patches) if len(patches) > 0 else 0
+        if profiler is not None:
+            profiler.record_commit(patches, time.perf_counter() - start)
+
+        # Update the tree and the handlers of the events
+        for node_id, node in handler_updates.items():
+            if node is None:
+                self.handlers.pop(node_id, None)
+            else:
+                self.handlers[node_id] = node
+        for callback, args in deferred:
+            callback(*args)
+
+        # If the server rendered HTML does not match the render, throw it away
+        # and render from scratch
+        if self.hydrating:
+            self.hydrating = False
+            if mismatches:
+                console.warn(
+                    f"PyDow: {mismatches} elements did not match the server "
+                    "rendered HTML, rendering from scratch"
+                )
+                self._forget(self.previous_tree)
+                self.patches.append(["setText", self.node_id, None])
+                self.styled = {}
+                self.handlers = {}
+                self.root = type(self.root)(dom=self)
+                self.previous_tree = self.root.render(
+                    parent_id=self.node_id, previous_tree=None
+                )
+                self.commit()
+                return
+
+        # Components rendered on the server are never mounted
+        self.mounted_components += len(mounting)
+        if self.mode == "server":
+            return
+        for component in mounting:
+            result = component.on_mount()
+            if inspect.iscoroutine(result):
+                component.create_task(result)
+
+
+def render_to_string(root: Type[Component]) -> str:
+    """ Render a component to HTML (with its CSS) without a browser, e.g. on a
+    server. Mount it in the browser with Dom(root, selector, mode="hydrate").
+    """
+    backend = HeadlessBackend()
+    mount = backend.document.createElement("div")
+    mount.setAttribute("id", "pydow-ssr")
+    backend.document.body.appendChild(mount)
+    dom = Dom(root=root, selector="#pydow-ssr", backend=backend, mode="server")
+    css = "\n".join(css for css in dom.styled.values() if css != "")
+    css = css.replace("</", "<\\/")
+    return f'<style type="text/css">{css}</style>{mount.innerHTML}'
 
 
 # Create a module from the code above
@@ -462,7 +4104,20 @@ main = types.ModuleType("main")
 # Add the elements to the module
 main.Component = Component
 main.Dom = Dom
+main.PersistentList = PersistentList
+main.PersistentDict = PersistentDict
+main.ObservableList = ObservableList
+main.VirtualList = VirtualList
+main.registry = registry
+main.Profiler = Profiler
+main.render_to_string = render_to_string
+main.BrowserBackend = BrowserBackend
+main.HeadlessBackend = HeadlessBackend
+main.HeadlessEvent = HeadlessEvent
+main.default_backend = default_backend
 main.fetch = fetch()
+main.template_cache = template_cache
+main.compiled_template_cache = compiled_template_cache
 main.console = console
 
 # Add the module to the sytem
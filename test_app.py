@@ -1,8 +1,6 @@
-import json
-
 from uuid import uuid4
 from typing import Optional
-from main import Component, fetch
+from main import Component, ObservableList, fetch
 
 
 class Root(Component):
@@ -12,6 +10,7 @@ class Root(Component):
     """
 
     tag = "main"
+    template_engine = "compiled"
     template = """
         <div class="uk-container">
 
@@ -33,9 +32,10 @@ class TodoItem:
     Args:
         title (str): The title of the todo item
         is_done (bool): Whether the todo item is already done
+        id (str): The id of the todo item, a new one by default
     """
-    def __init__(self, title: str, is_done: Optional[bool] = False) -> None:
-        self.id = str(uuid4())
+    def __init__(self, title: str, is_done: Optional[bool] = False, id: Optional[str] = None) -> None:
+        self.id = str(uuid4()) if id is None else id
         self.title = title
         self.is_done = is_done
 
@@ -43,11 +43,13 @@ class TodoItem:
 class TodoComponent(Component):
     """ The todo component on the page. The todo component will be rendered
     everywhere where the tag "todo-component" is used in a template. The template
-    is a Jinja2 template that will render all items in the list.
+    is a Jinja2 template that will render all items in the list. The list is
+    observable, so adding, removing or toggling an item only renders its row.
     """
 
     tag = "todo-component"
-    initial_state = {"todolist": []}
+    template_engine = "compiled"
+    initial_state = {"todolist": ObservableList()}
     template = """
         <div class="uk-grid-small" uk-grid>
             <div class="uk-width-3-4@s">
@@ -60,7 +62,7 @@ class TodoComponent(Component):
 
         <ul class="uk-list uk-list-divider">
             {% for item in todolist %}
-                <li>
+                <li key="{{ item.id }}">
                     <div class="uk-grid-small" uk-grid>
                         <div class="uk-width-3-4@s">
                             <p style="{{'text-decoration: line-through;' if item.is_done }}">{{ item.title }}</p>
@@ -79,31 +81,24 @@ class TodoComponent(Component):
         </ul>
     """
 
-    def on_mount(self) -> None:
+    async def on_mount(self) -> None:
         """ This method runs when the component is first mounted on the page. It
         uses the fetch API to retrieve some todo items from an API. Then, it will
         add the retrieved items to the state of this component so they get rendered.
+        The request is cancelled if the component is removed in the meantime.
         """
 
-        def create_initial_todos(data: str) -> None:
-            """ Helper method to parse a string as JSON data and convert the data into
-            todo items.
-
-            Args:
-                data (str): The raw JSON string to parse
-            """
+        # Retrieve the todos (identical requests are only sent once, and cached)
+        response = await fetch("https://jsonplaceholder.typicode.com/todos")
 
-            # Parse as JSON (only use the first 2 todo items)
-            items = json.loads(data)[:2]
+        # Only use the first 2 todo items
+        items = response.json()[:2]
 
-            # Set the state to the newly retrieved items
-            self.set_state(
-                "todolist",
-                [TodoItem(title=item["title"], is_done=True) for item in items],
-            )
-
-        # Use the fetch API to retrieve some sample todos
-        fetch("https://jsonplaceholder.typicode.com/todos").then(create_initial_todos)
+        # Set the state to the newly retrieved items
+        self.set_state(
+            "todolist",
+            ObservableList(TodoItem(title=item["title"], is_done=True) for item in items),
+        )
 
     def new_item(self, event) -> None:
         """ Create a new todo item. This method is called when the add button is clicked.
@@ -119,7 +114,7 @@ class TodoComponent(Component):
         if title != "":
 
             # Create a new item and add it to the state
-            self.state["todolist"] = [TodoItem(title=title), *self.state["todolist"]]
+            self.state["todolist"].insert(0, TodoItem(title=title))
 
             # Clear the input field to create another todo item
             self.clear_input_field()
@@ -132,13 +127,12 @@ class TodoComponent(Component):
             event (JS click event): The click event from the browser (JsProxy)
         """
 
-        # Set the state to the list of todos, filtered for the one that should be deleted
-        self.state["todolist"] = list(
-            filter(
-                lambda item: item.id != event.target.getAttribute("index"),
-                self.state.get("todolist", []),
-            )
-        )
+        # Delete the item from the list, only its row is removed from the page
+        todolist = self.state["todolist"]
+        for index, item in enumerate(todolist):
+            if item.id == event.target.getAttribute("index"):
+                del todolist[index]
+                break
 
     def clear_input_field(self) -> None:
         """ Clear the input field of the todo items.
@@ -156,15 +150,13 @@ class TodoComponent(Component):
         """
 
         # Get all the todo items from the state
-        state = self.state["todolist"]
+        todolist = self.state["todolist"]
 
-        # Loop the todo items, set the selected one to done
-        for index, item in enumerate(state):
+        # Loop the todo items, replace the selected one by a toggled copy. The
+        # list is observable, so only the row of the item is rendered again
+        for index, item in enumerate(todolist):
             if item.id == event.target.getAttribute("index"):
-                state[index].is_done = not state[index].is_done
-
-        # Update the state
-        self.set_state("todolist", state)
+                todolist[index] = TodoItem(item.title, not item.is_done, id=item.id)
 
 
 class Counter(Component):
@@ -172,6 +164,8 @@ class Counter(Component):
     """
 
     tag = "my-counter"
+    template_engine = "compiled"
+    memo = True
     template = """
         <div class="uk-margin-large">
             <p><span>The counter is at </span><span class="counter {{"red" if count < 0 else "green"}}">{{ count }}</span></p>
@@ -0,0 +1,99 @@
+""" Tests of build.py. The bundles run in a new Python process, in which
+Jinja2 can't be imported (like in the browser, without packages).
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+import build
+
+
+FRAMEWORK = os.path.join(os.path.dirname(os.path.abspath(build.__file__)), "pydow.py")
+
+COMPILED_APP = '''
+from main import Component
+
+
+class BuildRoot(Component):
+    tag = "b-root"
+    template_engine = "compiled"
+    initial_state = {"n": 3}
+    template = """<p>{{ n }}</p>"""
+    css = """p { color: red; }"""
+'''
+
+JINJA_APP = '''
+from main import Component
+
+
+class JinjaRoot(Component):
+    tag = "b-jinja-root"
+    template = """<p>{{ n }}</p>"""
+'''
+
+LIST_APP = '''
+from main import VirtualList
+
+
+class BuildRows(VirtualList):
+    tag = "b-rows"
+    row_template = """<p>{{ item }}</p>"""
+    initial_state = {"items": ["a", "b"]}
+'''
+
+RUN_BUNDLE = """
+import sys
+
+sys.modules["jinja2"] = None
+exec(compile(open(sys.argv[1]).read(), sys.argv[1], "exec"), {"__name__": "bundle"})
+main = sys.modules["main"]
+print(main.render_to_string(main.registry[sys.argv[2]]))
+"""
+
+
+def _write(directory, name, source):
+    path = directory / name
+    path.write_text(source)
+    return str(path)
+
+
+def _run_bundle(directory, source, tag):
+    path = _write(directory, "bundle.py", source)
+    result = subprocess.run(
+        [sys.executable, "-c", RUN_BUNDLE, path, tag],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout.strip()
+
+
+def test_bundle_runs_without_jinja(tmp_path):
+    source = build.build(_write(tmp_path, "compiled_app.py", COMPILED_APP), FRAMEWORK)
+
+    assert source.splitlines()[0] == f"# packages: {json.dumps([])}"
+    html = _run_bundle(tmp_path, source, "b-root")
+    assert "b-root p {" in html
+    assert html.endswith("<p>3</p></b-root>")
+
+
+def test_bundle_contains_the_row_templates_of_virtual_lists(tmp_path):
+    source = build.build(_write(tmp_path, "list_app.py", LIST_APP), FRAMEWORK)
+
+    assert source.splitlines()[0] == f"# packages: {json.dumps([])}"
+    html = _run_bundle(tmp_path, source, "b-rows")
+    assert "<p>a</p>" in html
+    assert "<p>b</p>" in html
+
+
+def test_templates_that_need_jinja_are_refused(tmp_path):
+    app = _write(tmp_path, "jinja_app.py", JINJA_APP)
+    with pytest.raises(build.BuildError, match="b-jinja-root"):
+        build.build(app, FRAMEWORK)
+
+    source = build.build(app, FRAMEWORK, allow_jinja=True)
+    assert source.splitlines()[0] == f"# packages: {json.dumps(['jinja2'])}"
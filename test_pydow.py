@@ -0,0 +1,565 @@
+""" Tests of PyDow, rendered with the headless DOM (run with pytest).
+"""
+
+import pytest
+
+import pydow
+
+from pydow import (
+    Component,
+    HeadlessEvent,
+    ObservableList,
+    PersistentDict,
+    PersistentList,
+    VirtualList,
+    render_to_string,
+)
+
+
+class KeyedList(Component):
+    tag = "t-keyed"
+    template_engine = "compiled"
+    initial_state = {"items": ["a", "b", "c", "d"]}
+    template = """<ul>{% for item in items %}<li key="{{ item }}">{{ item }}</li>{% endfor %}</ul>"""
+
+
+class Pair(Component):
+    tag = "t-pair"
+    template_engine = "compiled"
+    initial_state = {"a": 0, "b": 0}
+    template = """<div><p>{{ a }} {{ b }}</p><button on:click="increase">+</button></div>"""
+
+    def increase(self, event) -> None:
+        self.state["a"] += 1
+        self.state["b"] += 1
+
+
+class Flip(Component):
+    tag = "t-flip"
+    initial_state = {"on": False}
+    flips = 0
+
+    def flip(self, event) -> None:
+        self.state["on"] = not self.state["on"]
+        Flip.flips += 1
+
+
+class FlipApp(Component):
+    tag = "t-flip-app"
+    template_engine = "compiled"
+    template = """<div><t-flip><button on:click="flip">flip</button></t-flip></div>"""
+
+
+class Stopping(Component):
+    tag = "t-stopping"
+    template_engine = "compiled"
+    template = """<div on:click="outer"><button on:click="inner">x</button></div>"""
+    calls = []
+
+    def inner(self, event) -> None:
+        Stopping.calls.append("inner")
+        event.stopPropagation()
+
+    def outer(self, event) -> None:
+        Stopping.calls.append("outer")
+
+
+class Leaf(Component):
+    tag = "t-leaf"
+    template_engine = "compiled"
+    initial_state = {"v": 0}
+    template = """<b>{{ v }}</b>"""
+
+
+class Memoized(Component):
+    tag = "t-memoized"
+    template_engine = "compiled"
+    memo = True
+    template = """<div><t-leaf></t-leaf></div>"""
+
+
+class MemoApp(Component):
+    tag = "t-memo-app"
+    template_engine = "compiled"
+    initial_state = {"n": 0}
+    template = """<section><i>{{ n }}</i><t-memoized></t-memoized></section>"""
+
+
+class Box(Component):
+    tag = "t-box"
+    memo = True
+
+
+class BoxApp(Component):
+    tag = "t-box-app"
+    template_engine = "compiled"
+    initial_state = {"n": 0, "other": 0}
+    template = """<div><i>{{ other }}</i><t-box><b>{{ n }}</b></t-box></div>"""
+
+
+class Hydrated(Component):
+    tag = "t-hydrated"
+    template_engine = "compiled"
+    initial_state = {"n": 0}
+    template = """<div><b class="c{{ n }}">{{ n }}</b><button on:click="increase">+</button></div>"""
+
+    def increase(self, event) -> None:
+        self.state["n"] += 1
+
+
+class Themed(Component):
+    tag = "t-themed"
+    template_engine = "compiled"
+    template = """<i>{{ theme }}</i>"""
+
+
+class ThemedApp(Component):
+    tag = "t-themed-app"
+    template_engine = "compiled"
+    template = """<div><t-themed></t-themed></div>"""
+
+
+class GlobalRows(VirtualList):
+    tag = "t-global-rows"
+    row_template = "<p>{{ item }}</p>"
+
+
+class GlobalRowsApp(Component):
+    tag = "t-global-rows-app"
+    template_engine = "compiled"
+    template = """<div><t-global-rows></t-global-rows></div>"""
+
+
+class ScrolledRows(VirtualList):
+    tag = "t-scrolled-rows"
+    row_template = "<p>{{ index }}</p>"
+    row_height = 30
+    height = 300
+    overscan = 2
+    initial_state = {"items": list(range(1000))}
+
+
+class Colliding:
+    """ A key of which the hash collides with every other one.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __hash__(self) -> int:
+        return 42
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Colliding) and other.name == self.name
+
+
+class Todos(Component):
+    tag = "t-todos"
+    template_engine = "compiled"
+    initial_state = {"todos": PersistentList(["a", "b"])}
+    template = """<ul>{% for todo in todos %}<li>{{ todo }}</li>{% endfor %}</ul>"""
+
+
+client = pydow.fetch()
+
+
+class Fetching(Component):
+    tag = "t-fetching"
+    template_engine = "compiled"
+    initial_state = {"text": ""}
+    template = """<p>{{ text }}</p>"""
+
+    async def on_mount(self) -> None:
+        cached = await client("/cached")
+        uncached = await client("/uncached", cache=False)
+        self.state["text"] = cached.text() + uncached.text()
+
+
+class Row(Component):
+    tag = "t-row"
+    template_engine = "compiled"
+    template = """<p class="{{ theme }}">{{ label }}</p>"""
+
+
+class Rows(Component):
+    tag = "t-rows"
+    template_engine = "compiled"
+    initial_state = {"labels": [], "query": ""}
+    template = """<div><i>{{ query }}</i>{% for label in labels %}<t-row label="{{ label }}"></t-row>{% endfor %}</div>"""
+
+
+class Query(Component):
+    tag = "t-query"
+    template_engine = "compiled"
+    initial_state = {"query": ""}
+    template = """<i>{{ query }}</i>"""
+
+
+class Search(Component):
+    tag = "t-search"
+    template_engine = "compiled"
+    template = """<div><t-query></t-query><t-rows></t-rows></div>"""
+
+
+class Child(Component):
+    tag = "t-child"
+    template_engine = "compiled"
+    template = """<button class="{{ theme }}" on:click="click">x</button>"""
+    unmounted = 0
+
+    def click(self, event) -> None:
+        pass
+
+    def on_unmount(self) -> None:
+        Child.unmounted += 1
+
+
+class Toggle(Component):
+    tag = "t-toggle"
+    template_engine = "compiled"
+    initial_state = {"show": True}
+    template = """<div>{% if show %}<t-child></t-child><t-child></t-child>{% endif %}</div>"""
+
+
+class Bound(Component):
+    tag = "t-bound"
+    template_engine = "compiled"
+    initial_state = {"rows": ObservableList(["a", "b", "c"])}
+    template = """<ul>{% for row in rows %}<li key="{{ row }}">{{ row }}</li>{% endfor %}</ul>"""
+
+
+def _texts(backend, selector):
+    return [element.textContent for element in backend.document.querySelectorAll(selector)]
+
+
+def test_keyed_children_are_moved(mount):
+    dom, backend, _ = mount(KeyedList)
+    elements = {li.textContent: li for li in backend.document.querySelectorAll("li")}
+
+    dom.root.state["items"] = ["d", "b", "a", "c"]
+    backend.window.run_animation_frame()
+
+    assert _texts(backend, "li") == ["d", "b", "a", "c"]
+    assert all(li is elements[li.textContent] for li in backend.document.querySelectorAll("li"))
+
+
+def test_writes_are_batched(mount):
+    dom, backend, _ = mount(Pair)
+    commits = []
+    dom.start_profiling().subscribe(commits.append)
+
+    backend.document.querySelector("button").click()
+    assert _texts(backend, "p") == ["1 1"]
+    assert len(commits) == 1
+
+    with dom.batch():
+        dom.root.state["a"] = 5
+        dom.root.state["b"] = 6
+    assert _texts(backend, "p") == ["5 6"]
+    assert len(commits) == 2
+
+
+def test_compiled_templates_call_jinja_globals():
+    render = pydow.compile_template("""<p>{% for i in range(3) %}<b>{{ i }}</b>{% endfor %}{{ dict(a=1)["a"] }}</p>""")
+    assert render is not None
+    nodes = render({})
+    assert [child.content for child in nodes[0].children] == ["0", "1", "2"]
+    assert render({"range": lambda n: ["x"]})[0].children[0].content == "x"
+
+
+def test_compiled_filters_follow_jinja():
+    render = pydow.compile_template("""<p>{{ a|int }} {{ b|int }} {{ b|int(7) }} {{ a|float }} {{ b|float }}</p>""")
+    assert render is not None
+    assert render({"a": "3.5", "b": "abc"})[0].content == "3 0 7 3.5 0.0"
+
+    # The text of compiled templates is never parsed, so safe needs Jinja
+    assert pydow.compile_template("""<p>{{ a|safe }}</p>""") is None
+
+
+def test_handed_down_nodes_keep_their_handlers(mount):
+    dom, backend, _ = mount(FlipApp)
+    Flip.flips = 0
+    for _ in range(3):
+        backend.document.querySelector("button").click()
+    assert Flip.flips == 3
+
+
+def test_stop_propagation_keeps_listeners_of_the_target(mount):
+    dom, backend, _ = mount(Stopping)
+    Stopping.calls = []
+    button = backend.document.querySelector("button")
+    button.addEventListener("click", lambda event: Stopping.calls.append("native"))
+
+    button.click()
+    assert Stopping.calls == ["native", "inner"]
+
+
+def test_memo_skips_unchanged_components(mount):
+    dom, backend, _ = mount(MemoApp)
+    profiler = dom.start_profiling()
+
+    dom.root.state["n"] = 1
+    backend.window.run_animation_frame()
+    assert _texts(backend, "i") == ["1"]
+    assert profiler.components["t-memoized"]["renders"] == 0
+    assert profiler.components["t-memoized"]["skipped"] == 1
+    assert "t-leaf" not in profiler.components
+
+
+def test_memo_renders_dirty_descendants(mount):
+    dom, backend, _ = mount(MemoApp)
+    leaf = next(node for node in dom.previous_tree._subtree() if isinstance(node, Leaf))
+
+    with dom.batch():
+        dom.root.state["n"] = 1
+        leaf.state["v"] = 5
+    assert _texts(backend, "i") == ["1"]
+    assert _texts(backend, "b") == ["5"]
+
+
+def test_memo_compares_handed_down_nodes(mount):
+    dom, backend, _ = mount(BoxApp)
+    profiler = dom.start_profiling()
+
+    dom.root.state["other"] = 1
+    backend.window.run_animation_frame()
+    assert profiler.components["t-box"]["skipped"] == 1
+
+    dom.root.state["n"] = 3
+    backend.window.run_animation_frame()
+    assert _texts(backend, "b") == ["3"]
+
+
+def test_hydrate_adopts_the_server_html(mount):
+    html = render_to_string(Hydrated)
+    dom, backend, _ = mount(Hydrated, mode="hydrate", html=html)
+    bold = backend.document.querySelector("b")
+
+    backend.document.querySelector("button").click()
+    assert backend.document.querySelector("b") is bold
+    assert bold.textContent == "1"
+    assert bold.getAttribute("class") == "c1"
+
+
+def test_hydrate_renders_another_state_from_scratch(mount):
+    html = render_to_string(Hydrated).replace(">0<", ">7<")
+    dom, backend, _ = mount(Hydrated, mode="hydrate", html=html)
+
+    assert _texts(backend, "b") == ["0"]
+    backend.document.querySelector("button").click()
+    assert _texts(backend, "b") == ["1"]
+
+
+def test_hydrate_mismatch_releases_the_hydrated_tree(mount):
+    dom, backend, _ = mount(ThemedApp, mode="hydrate", html="<t-themed-app><span></span></t-themed-app>")
+
+    dom.state["theme"] = "dark"
+    backend.window.run_animation_frame()
+    assert _texts(backend, "i") == ["dark"]
+    assert dom.info()["readers"] == 1
+    assert dom.info()["components"] == 2
+
+
+def test_profiler_records_renders_and_commits(mount):
+    dom, backend, _ = mount(Pair)
+    profiler = dom.start_profiling()
+    records = []
+    profiler.subscribe(records.append)
+
+    backend.document.querySelector("button").click()
+    assert [trigger["key"] for trigger in records[0]["triggers"]] == ["a", "b"]
+    assert records[0]["rendered"] == {"t-pair": 1}
+    assert records[0]["operations"] == {"setText": 1}
+    assert profiler.snapshot()["components"]["t-pair"]["renders"] == 1
+
+    # Renders aren't recorded once profiling stops
+    assert dom.stop_profiling() is profiler
+    dom.root.state["a"] = 9
+    backend.window.run_animation_frame()
+    assert profiler.snapshot()["commits"] == 1
+    assert len(records) == 1
+
+
+def test_fetch_uses_the_backend_of_the_dom(mount):
+    dom, backend, _ = mount(Fetching)
+    backend.window.transport = lambda url, options: (200, url)
+    backend.window.run_animation_frame()
+    backend.window.run_animation_frame()
+
+    assert _texts(backend, "p") == ["/cached/uncached"]
+    assert client.info()["size"] == 1
+
+
+def test_compile_template_needs_jinja(monkeypatch):
+    monkeypatch.setattr(pydow, "Template", None)
+    with pytest.raises(ImportError, match="Jinja2 is required"):
+        pydow.compile_template("""<p>{{ a }}</p>""")
+
+
+def test_virtual_list_takes_items_from_the_global_state(mount):
+    dom, backend, _ = mount(GlobalRowsApp)
+    dom.state["items"] = [f"row {i}" for i in range(100)]
+    backend.window.run_animation_frame()
+    assert _texts(backend, "t-global-rows p")[:2] == ["row 0", "row 1"]
+
+
+def test_virtual_list_reuses_rows_while_scrolling(mount):
+    dom, backend, _ = mount(ScrolledRows)
+    rows = backend.document.querySelectorAll(".pydow-row")
+    assert _texts(backend, "p") == [str(i) for i in range(12)]
+
+    # The rows that scroll into view reuse the elements of the others
+    viewport = backend.document.querySelector(".pydow-viewport")
+    viewport.scrollTop = 3005
+    viewport.dispatchEvent(HeadlessEvent("scroll", bubbles=False))
+    assert sorted(int(text) for text in _texts(backend, "p")) == list(range(98, 113))
+    assert all(row in backend.document.querySelectorAll(".pydow-row") for row in rows)
+
+    # Scrolling within the same rows doesn't render
+    viewport.scrollTop = 3010
+    viewport.dispatchEvent(HeadlessEvent("scroll", bubbles=False))
+    assert dom.root.state["scroll_top"] == 3005
+
+
+def test_persistent_list_matches_a_list():
+    items = list(range(1100))
+    persistent = PersistentList(range(1000))
+    for i in range(1000, 1100):
+        persistent = persistent.append(i)
+    assert len(persistent) == 1100
+    assert list(persistent) == items
+
+    # Changes return new versions, the old ones stay the same
+    changed = persistent.set(1050, "x").set(-1, "y")
+    assert changed[1050] == "x"
+    assert changed[-1] == "y"
+    assert persistent[1050] == 1050
+    assert persistent.insert(0, "a")[:2] == ["a", 0]
+    assert persistent.delete(0)[0] == 1
+    assert persistent == items
+
+
+def test_persistent_dict_matches_a_dict():
+    expected = {i: str(i) for i in range(2000)}
+    persistent = PersistentDict(expected)
+    keys = [Colliding(name) for name in "abc"]
+    for key in keys:
+        persistent = persistent.set(key, key.name)
+        expected[key] = key.name
+    assert len(persistent) == len(expected)
+    assert dict(persistent.items()) == expected
+
+    deleted = persistent.delete(keys[1]).delete(5)
+    assert keys[1] not in deleted
+    assert keys[2] in deleted
+    assert 5 not in deleted
+    assert len(deleted) == len(expected) - 2
+    assert keys[1] in persistent
+
+
+def test_persistent_state_is_compared_by_version(mount):
+    dom, backend, _ = mount(Todos)
+    profiler = dom.start_profiling()
+
+    todos = dom.root.state["todos"]
+    dom.root.state["todos"] = todos
+    backend.window.run_animation_frame()
+    assert profiler.commits == 0
+
+    dom.root.state["todos"] = todos.set(1, "c")
+    backend.window.run_animation_frame()
+    assert _texts(backend, "li") == ["a", "c"]
+    assert profiler.commits == 1
+
+
+def _finish(dom, backend):
+    backend.window.performance.tick = 0
+    while dom._work is not None or any(dom._dirty):
+        backend.window.run_animation_frame()
+
+
+def test_urgent_updates_interrupt_transitions(mount):
+    dom, backend, _ = mount(Search)
+    query, rows = [
+        next(node for node in dom.previous_tree._subtree() if isinstance(node, kind))
+        for kind in (Query, Rows)
+    ]
+    backend.window.performance.tick = 1
+    with dom.transition():
+        rows.state["labels"] = list(range(100))
+    backend.window.run_animation_frame()
+    assert dom._work is not None
+    assert len(backend.document.querySelectorAll("t-row")) == 0
+
+    # The urgent update is committed first, the transition starts over
+    with dom.batch():
+        query.state["query"] = "x"
+    assert _texts(backend, "t-query i") == ["x"]
+    assert dom._work is None
+    assert len(backend.document.querySelectorAll("t-row")) == 0
+
+    _finish(dom, backend)
+    assert _texts(backend, "t-query i") == ["x"]
+    assert len(backend.document.querySelectorAll("t-row")) == 100
+
+
+def test_abandoned_renders_dont_subscribe(mount):
+    dom, backend, _ = mount(Rows)
+    backend.window.performance.tick = 1
+    for i in range(5):
+        with dom.transition():
+            dom.root.state["labels"] = list(range(100 + i))
+        backend.window.run_animation_frame()
+        with dom.batch():
+            dom.root.state["query"] = str(i)
+    _finish(dom, backend)
+
+    rows = len(backend.document.querySelectorAll("t-row"))
+    assert rows == 104
+
+    # Every row reads theme and label (its attribute) from the global state
+    assert dom.info()["readers"] == 2 * rows
+
+
+def test_unmount_releases_everything(mount):
+    dom, backend, _ = mount(Toggle)
+    dom.state["theme"] = "dark"
+    backend.window.run_animation_frame()
+    info = dom.info()
+    Child.unmounted = 0
+
+    for _ in range(10):
+        dom.root.state["show"] = False
+        backend.window.run_animation_frame()
+        dom.root.state["show"] = True
+        backend.window.run_animation_frame()
+
+    assert dom.info() == info
+    assert Child.unmounted == 20
+
+    dom.unmount()
+    assert set(dom.info().values()) == {0}
+    assert Child.unmounted == 22
+
+
+def test_list_binding_renders_only_changed_rows(mount, monkeypatch):
+    dom, backend, _ = mount(Bound)
+    elements = {li.textContent: li for li in backend.document.querySelectorAll("li")}
+    renders = []
+    child_nodes = Bound._child_nodes
+    monkeypatch.setattr(Bound, "_child_nodes", lambda self: renders.append(self) or child_nodes(self))
+
+    rows = dom.root.state["rows"]
+    rows.insert(1, "x")
+    del rows[0]
+    rows[-1] = "z"
+    backend.window.run_animation_frame()
+
+    assert _texts(backend, "li") == ["x", "b", "z"]
+    assert backend.document.querySelectorAll("li")[1] is elements["b"]
+    assert renders == []
+
+    rows.sort()
+    backend.window.run_animation_frame()
+    assert _texts(backend, "li") == ["b", "x", "z"]
+    assert Bound.initial_state["rows"] == ["a", "b", "c"]